@@ -0,0 +1,102 @@
+"""
+Benchmark of the geolocation lookups of the proxy.
+
+Compares the reader modes selectable with the proxy --db-mode option, then looks up the same addresses through
+the MaxMind reader in MODE_FILE (what the proxy did per message), the GeoCache in front of that reader and the
+PrefixIndex, with uniformly random addresses and with a skewed feed where a few thousand addresses produce
+most of the traffic.
+
+    python benchmarks/geolocation.py --database cyberserver/databases/GeoLite2-City.mmdb
+"""
+import time
+import random
+import pathlib
+import tempfile
+
+import click
+import maxminddb
+
+from cyberserver.servers.geolocation import GeoCache, PrefixIndex, DATABASE_MODES, open_reader, clean_ip, located
+
+
+_script_path = pathlib.Path(__file__)
+
+
+def random_ipv4() -> str:
+    return ".".join(str(random.randint(1, 254)) for _ in range(4))
+
+
+def lookups_per_second(lookup, addresses) -> float:
+    started = time.perf_counter()
+    for ip in addresses:
+        lookup(ip)
+    return len(addresses) / (time.perf_counter() - started)
+
+
+@click.command(context_settings = {"help_option_names": ['-h', '--help']})
+@click.option(
+    "-db",
+    "--database",
+    type = click.Path(exists = True, dir_okay = False),
+    default = str(_script_path.parent.parent.joinpath("cyberserver/databases/GeoLite2-City.mmdb")),
+    help = "Path to maxmind database"
+)
+@click.option("--lookups", default = 200000, type = click.IntRange(1, None), help = "Lookups per run")
+@click.option("--scanners", default = 5000, type = click.IntRange(1, None), help = "Distinct addresses of the skewed feed")
+def main(database, lookups, scanners):
+    uniform = [random_ipv4() for _ in range(lookups)]
+    population = [random_ipv4() for _ in range(scanners)]
+    skewed = random.choices(population, weights = [1 / (rank + 1) for rank in range(scanners)], k = lookups)
+    
+    click.echo(f"{'--db-mode':<20}{'open ms':>20}{'uniform lookups/s':>20}")
+    for mode in DATABASE_MODES:
+        try:
+            started = time.perf_counter()
+            mode_reader = open_reader(database, mode)
+            opened = (time.perf_counter() - started) * 1000
+        except ValueError as e:
+            click.echo(f"{mode:<20}{'unavailable':>20}  {e}")
+            continue
+        with mode_reader:
+            rate = lookups_per_second(lambda ip: located(clean_ip(mode_reader.get(ip))), uniform)
+        click.echo(f"{mode:<20}{opened:>20,.1f}{rate:>20,.0f}")
+    click.echo()
+    
+    with tempfile.TemporaryDirectory() as folder:
+        index_path = pathlib.Path(folder) / "GeoLite2-City.index"
+        
+        started = time.perf_counter()
+        index = PrefixIndex.build(database)
+        build = time.perf_counter() - started
+        index.save(index_path)
+        
+        started = time.perf_counter()
+        index = PrefixIndex.load(index_path, database)
+        load = time.perf_counter() - started
+        click.echo(
+            f"index of {len(index)} networks and {len(index.records)} records: "
+            f"built in {build:.2f}s, loaded in {load:.2f}s, {index_path.stat().st_size / 2 ** 20:.1f} MB on disk"
+        )
+    
+    reader = maxminddb.open_database(database, mode = maxminddb.MODE_FILE)
+    candidates = {
+        "MODE_FILE reader": lambda ip: located(clean_ip(reader.get(ip))),
+        "GeoCache": None,
+        "PrefixIndex": index.get,
+    }
+    
+    click.echo(f"{'':<20}{'uniform lookups/s':>20}{'skewed lookups/s':>20}")
+    for name, lookup in candidates.items():
+        results = list()
+        for addresses in (uniform, skewed):
+            if name == "GeoCache":
+                # a cold cache for every feed
+                lookup = GeoCache(reader, size = 65536).get
+            results.append(lookups_per_second(lookup, addresses))
+        click.echo(f"{name:<20}{results[0]:>20,.0f}{results[1]:>20,.0f}")
+    
+    reader.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Benchmark of the proxy ingestion with --workers.
+
+For every number of workers a backlog of raw attacks is appended to the raw attacks stream, then a proxy started
+with --transport streams drains it and the attacks processed per second are reported. A backlog measures what the
+proxy can take without a producer competing for the CPUs, it should grow about linearly with the workers until the
+CPUs of the host run out. The benchmark uses the streams of production, no other proxy or generator may be running
+on the redis-server.
+
+    python benchmarks/proxy_workers.py --workers 1 --workers 2 --workers 4 --attacks 200000
+"""
+import os
+import sys
+import time
+import random
+import pathlib
+import subprocess
+
+import click
+import redis
+
+from cyberserver.servers.utilities import encode_attack, ATTACK_TYPES, STREAM_GROUP
+
+
+_script_path = pathlib.Path(__file__)
+
+RECEIVE_STREAM = "raw-cyberattacks"
+FORWARD_STREAM = "cyberattacks"
+
+
+def random_ipv4() -> str:
+    return ".".join(str(random.randint(1, 222 if part == 0 else 254)) for part in range(4))
+
+
+def fill_backlog(server: redis.Redis, attacks: int) -> bytes:
+    """ Appends attacks raw attacks to an empty raw stream, read by the consumer group from its first entry """
+    server.delete(RECEIVE_STREAM, FORWARD_STREAM)
+    last_id = b"0-0"
+    for start in range(0, attacks, 1000):
+        pipeline = server.pipeline(transaction = False)
+        for _ in range(min(1000, attacks - start)):
+            pipeline.xadd(RECEIVE_STREAM, {"data": encode_attack({
+                "src": {"ip": random_ipv4(), "port": 22},
+                "dst": {"ip": random_ipv4(), "port": 22},
+                "type": random.choice(ATTACK_TYPES),
+                "cve": f"CVE:{random.randrange(1997, 2019)}:{random.randrange(1, 400)}",
+            })})
+        last_id = pipeline.execute()[-1]
+    server.xgroup_create(RECEIVE_STREAM, STREAM_GROUP, id = "0")
+    return last_id
+
+
+def measure(database: str, workers: int, attacks: int) -> float:
+    """ Raw attacks per second a proxy with that many workers processes """
+    server = redis.Redis()
+    last_id = fill_backlog(server, attacks)
+    
+    proxy = subprocess.Popen(
+        [
+            sys.executable, "-m", "cyberserver.servers.proxy", "--silent", "-db", database, "-t", "streams",
+            "--workers", str(workers), "--stream-maxlen", str(attacks), "--stats-interval", "0"
+        ],
+        stdout = subprocess.DEVNULL,
+        stderr = subprocess.DEVNULL
+    )
+    try:
+        # timed from the first forged attack, opening the database is not part of the ingestion
+        while not server.exists(FORWARD_STREAM):
+            time.sleep(0.01)
+        started = time.monotonic()
+        while True:
+            group, = server.xinfo_groups(RECEIVE_STREAM)
+            if group["last-delivered-id"] == last_id and group["pending"] == 0:
+                return attacks / (time.monotonic() - started)
+            time.sleep(0.01)
+    finally:
+        proxy.terminate()
+        proxy.wait()
+        server.delete(RECEIVE_STREAM, FORWARD_STREAM)
+
+
+@click.command(context_settings = {"help_option_names": ['-h', '--help']})
+@click.option(
+    "-db",
+    "--database",
+    type = click.Path(exists = True, dir_okay = False),
+    default = str(_script_path.parent.parent.joinpath("cyberserver/databases/GeoLite2-City.mmdb")),
+    help = "Path to maxmind database"
+)
+@click.option("--workers", "workers", multiple = True, default = [1, 2, 4], type = click.IntRange(1, None),
+              help = "Workers of a run, repeat for several runs")
+@click.option("--attacks", default = 200000, type = click.IntRange(1, None), help = "Raw attacks of the backlog")
+def main(database, workers, attacks):
+    click.echo(f"{os.cpu_count()} CPUs, {attacks} raw attacks per run")
+    click.echo(f"{'--workers':<12}{'attacks/s':>12}{'speedup':>10}")
+    baseline = None
+    for count in workers:
+        rate = measure(database, count, attacks)
+        baseline = baseline or rate
+        click.echo(f"{count:<12}{rate:>12,.0f}{rate / baseline:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
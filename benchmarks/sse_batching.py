@@ -0,0 +1,131 @@
+"""
+Benchmark of the SSE fan-out with and without batching.
+
+A synthetic feed is dispatched straight into the broadcaster (no redis needed) while a separate process keeps
+<clients> /events connections open and discards what it reads. For each configuration the socket writes per second
+(one send syscall per client write) and the CPU seconds of the server are reported, normalized per 1k clients.
+
+    python benchmarks/sse_batching.py --clients 1000 --rate 500 --duration 10
+"""
+import time
+import json
+import random
+import asyncio
+import logging
+import resource
+import multiprocessing
+
+import click
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+
+from cyberserver.servers.SSE_test import Cybermap
+from cyberserver.servers.handler import Broadcaster, CHANNEL, STATS_CHANNEL
+
+
+class SyntheticBroadcaster(Broadcaster):
+    """ Broadcaster fed by the benchmark instead of redis """
+    
+    async def start(self):
+        pass
+
+
+def attack(event_id: int) -> bytes:
+    return json.dumps({
+        "id": f"0-{event_id}",
+        "protocol": "SSH",
+        "src": {"country": "Greece", "latitude": 35.3, "longitude": 25.1},
+        "dst": {"country": "Germany", "latitude": 52.5, "longitude": 13.4},
+        "cve": f"CVE:{random.randrange(1997, 2019)}:{random.randrange(1, 400)}",
+        "event_time": "2020-01-01 00:00:00",
+    }).encode()
+
+
+def run_clients(port: int, clients: int, lifetime: float):
+    async def client():
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /events HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        while await reader.read(65536):
+            pass
+    
+    async def main():
+        tasks = list()
+        for _ in range(clients):
+            tasks.append(asyncio.ensure_future(client()))
+            await asyncio.sleep(0)
+        await asyncio.wait(tasks, timeout = lifetime)
+    
+    asyncio.run(main())
+
+
+async def measure(clients: int, rate: int, duration: float, **batching) -> dict:
+    broadcaster = SyntheticBroadcaster(**batching)
+    sock, port = bind_unused_port()
+    server = HTTPServer(Cybermap(broadcaster = broadcaster, queue_limit = 4096))
+    server.add_sockets([sock])
+    
+    process = multiprocessing.Process(target = run_clients, args = (port, clients, duration + 60), daemon = True)
+    process.start()
+    while len(broadcaster.clients) < clients:
+        await asyncio.sleep(0.1)
+    
+    def total_writes():
+        return sum(client.writes for client in broadcaster.clients.values())
+    
+    writes, cpu, started = total_writes(), time.process_time(), time.monotonic()
+    sent, tick = 0, 0.01
+    while time.monotonic() - started < duration:
+        due = int((time.monotonic() - started) * rate)
+        while sent < due:
+            sent += 1
+            broadcaster.dispatch(CHANNEL, attack(sent))
+        if sent % (rate * 3) == 0:
+            broadcaster.dispatch(STATS_CHANNEL, b'{"types": {"TOTAL": %d}}' % sent)
+        await asyncio.sleep(tick)
+    broadcaster.flush_batch()
+    await asyncio.sleep(0.5)
+    
+    elapsed = time.monotonic() - started
+    result = {
+        "events/s": sent / elapsed,
+        "writes/s": (total_writes() - writes) / elapsed,
+        "cpu s/s per 1k clients": (time.process_time() - cpu) / elapsed * 1000 / clients,
+    }
+    
+    process.terminate()
+    process.join()
+    server.stop()
+    # let the handlers see their connections close before the loop goes away
+    while broadcaster.clients:
+        await asyncio.sleep(0.1)
+    return result
+
+
+@click.command(context_settings = {"help_option_names": ['-h', '--help']})
+@click.option("--clients", default = 1000, type = click.IntRange(1, None), help = "Concurrent /events connections")
+@click.option("--rate", default = 500, type = click.IntRange(1, None), help = "Attacks dispatched per second")
+@click.option("--duration", default = 10.0, type = click.FloatRange(1, None), help = "Seconds measured per run")
+@click.option("--batch-interval", default = 0.05, type = click.FloatRange(0, None), help = "Batching window")
+@click.option("--batch-size", default = 64, type = click.IntRange(1, None), help = "Batch size")
+def main(clients, rate, duration, batch_interval, batch_size):
+    logging.disable(logging.INFO)
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (max(soft, min(hard, 4 * clients + 256)), hard))
+    
+    runs = {
+        "batching off": dict(),
+        "batching on": dict(batch_interval = batch_interval, batch_size = batch_size),
+        "batch event": dict(batch_interval = batch_interval, batch_size = batch_size, batch_event = True),
+    }
+    click.echo(f"{clients} clients, {rate} attacks/s, {duration}s per run")
+    click.echo(f"{'':<14}{'events/s':>12}{'writes/s':>14}{'cpu/1k clients':>16}")
+    for name, batching in runs.items():
+        result = asyncio.run(measure(clients, rate, duration, **batching))
+        click.echo(
+            f"{name:<14}{result['events/s']:>12.1f}{result['writes/s']:>14.1f}"
+            f"{result['cpu s/s per 1k clients']:>16.3f}"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Benchmark of ServerStats under contention.
+
+Ingest threads record attacks as fast as they can, like the ingest loop of the proxy, while reader threads keep
+reading the statistics the way the stats-worker and the snapshotter do: snapshot, totals and the delta encoder.
+The ingest rate is reported with and without the readers: recording never waits for a reader, the readers only
+take their share of the CPUs. The consistency of the reads is asserted by tests/test_server_stats.py.
+
+    python benchmarks/stats_stress.py --attacks 500000 --writers 2 --readers 4
+"""
+import time
+import random
+import threading
+from collections import Counter
+from typing import List, Tuple
+
+import click
+
+from cyberserver.servers.proxy import ServerStats, StatsEncoder
+from cyberserver.servers.utilities import ATTACK_TYPES
+
+
+COUNTRIES = ["Greece", "Germany", "China", "United States", "Brazil", "Russia", "India", "France", None]
+
+
+def attacks_of(seed: int, attacks: int) -> List[Tuple[str, str, str]]:
+    generator = random.Random(seed)
+    return [
+        (generator.choice(ATTACK_TYPES), generator.choice(COUNTRIES), generator.choice(COUNTRIES))
+        for _ in range(attacks)
+    ]
+
+
+def run(feeds: List[List[Tuple[str, str, str]]], readers: int) -> Tuple[ServerStats, float, int]:
+    """ Records the feeds from one thread each while readers read, returns the stats, attacks/s and reads """
+    stats = ServerStats()
+    done = threading.Event()
+    reads = Counter()
+    
+    def ingest(feed: List[Tuple[str, str, str]]):
+        for attack in feed:
+            stats.record(*attack)
+    
+    def read(index: int):
+        encoder = StatsEncoder(snapshot_every = 5)
+        while not done.is_set():
+            with stats.reading() as current:
+                current.totals()
+                current.snapshot()
+                encoder.encode(current)
+            reads[index] += 1
+    
+    reader_threads = [threading.Thread(target = read, args = (index,), daemon = True) for index in range(readers)]
+    writer_threads = [threading.Thread(target = ingest, args = (feed,), daemon = True) for feed in feeds]
+    for thread in reader_threads:
+        thread.start()
+    
+    started = time.perf_counter()
+    for thread in writer_threads:
+        thread.start()
+    for thread in writer_threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    
+    done.set()
+    for thread in reader_threads:
+        thread.join()
+    return stats, sum(len(feed) for feed in feeds) / elapsed, sum(reads.values())
+
+
+@click.command(context_settings = {"help_option_names": ['-h', '--help']})
+@click.option("--attacks", default = 500000, type = click.IntRange(1, None), help = "Attacks recorded per writer")
+@click.option("--writers", default = 1, type = click.IntRange(1, None), help = "Threads recording attacks")
+@click.option("--readers", default = 4, type = click.IntRange(1, None), help = "Threads reading the statistics")
+def main(attacks, writers, readers):
+    feeds = [attacks_of(seed, attacks) for seed in range(writers)]
+    
+    _, alone, _ = run(feeds, readers = 0)
+    _, contended, reads = run(feeds, readers = readers)
+    
+    click.echo(f"{writers} writers of {attacks} attacks, {readers} readers")
+    click.echo(f"{'ingest without readers':<28}{alone:>14,.0f} attacks/s")
+    click.echo(f"{'ingest with readers':<28}{contended:>14,.0f} attacks/s, {reads} reads")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,28 @@
+import os
+import sys
 import signal
+import socket
 import pathlib
-from typing import Optional, Awaitable
+import resource
+import functools
+from typing import Optional, Awaitable, Dict, Any
 
-from tornado import web
+import tornado.locale
+from tornado import web, template
 from tornado.log import app_log
 from tornado.options import options, define, parse_command_line
 from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.process import fork_processes, task_id
 from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.iostream import StreamClosedError
 
 from . import SSEHandler
+from .handler import Broadcaster, MetricsHandler, QUEUE_POLICIES
+from .static_cache import CachedFile, CachedFileHandler, CachedStaticFileHandler, ENCODINGS
 from .utilities.colors import colorize
+from .utilities.codec import available_codecs, get_codec, use_codec
+from .utilities.redis_watcher import TRANSPORTS
 import logging
 
 import click
@@ -27,36 +39,131 @@ _script_name = pathlib.Path(__file__).name
 # _map_path = _script_path.parent.parent.joinpath("map")
 _map_path = pathlib.Path("/srv/www/cybermap")
 _map_index_page = _map_path.joinpath("index.html")
+# served by NGINX, or by tornado with --no-nginx
+_map_static_directories = ("js", "css", "assets")
 
 
 class Cybermap(web.Application):
-    def __init__(self):
+    def __init__(
+            self,
+            broadcaster: Optional[Broadcaster] = None,
+            queue_limit: int = 256,
+            queue_policy: str = "drop-oldest",
+            backpressure_timeout: float = 10.0,
+            connections_interval: float = 1.0,
+            no_nginx: bool = False
+    ):
+        self.no_nginx: bool = no_nginx
+        if broadcaster is not None:
+            SSEHandler.broadcaster = broadcaster
+        # shared by every client of the application, see start
+        self.broadcaster: Broadcaster = SSEHandler.broadcaster
+        # the clients of this process, summed with the other processes by /metrics
+        self.connections_reporter = PeriodicCallback(
+            self.broadcaster.report_connections,
+            callback_time = connections_interval * 1000
+        )
+        
+        sse_settings = dict(
+            queue_limit = queue_limit,
+            queue_policy = queue_policy,
+            backpressure_timeout = backpressure_timeout,
+        )
         handlers = [
                        (r'/', MainHandler),
-                       (r'/events', SSEHandler),
-                       # UNCOMMENT IF YOU DONT USE NGINX
-                       # (r'/js/(.*)', web.StaticFileHandler, {'path': str(_map_path.joinpath('js'))}),
-                       # UNCOMMENT IF YOU DONT USE NGINX
-                       # (r'/css/(.*)', web.StaticFileHandler, {'path': str(_map_path.joinpath('css'))}),
-                       # UNCOMMENT IF YOU DONT USE NGINX
-                       # (r'/assets/(.*)', web.StaticFileHandler, {'path': str(_map_path.joinpath('assets'))}),
+                       (r'/events', SSEHandler, sse_settings),
+                       (r'/metrics', MetricsHandler),
                    ],
+        if no_nginx:
+            # the scripts, styles and assets of the map, served from memory like the index page
+            handlers[0].extend(
+                (rf'/{directory}/(.*)', CachedStaticFileHandler, {'path': str(_map_path.joinpath(directory))})
+                for directory in _map_static_directories
+            )
         settings = dict(
             # cookie_secret="__TODO:_GENERATE_YOUR_OWN_RANDOM_VALUE_HERE__",
             # xsrf_cookies=True,
             debug = False,
         )
         web.Application.__init__(self, *handlers, **settings)
+    
+    def preload(self):
+        """ Renders and compresses the pages of the map in memory, before the first request """
+        try:
+            MainHandler.preload(self)
+        except FileNotFoundError:
+            logger.warning(f"{_map_index_page} not found, it will be served once it exists")
+        if self.no_nginx:
+            for directory in _map_static_directories:
+                files = CachedStaticFileHandler.preload(_map_path.joinpath(directory))
+                logger.info(f"Cached {colorize(files, 'gold_1')} files of {_map_path.joinpath(directory)}")
+    
+    async def start(self):
+        """
+        Caches the pages of the map, connects to redis and subscribes once for the whole application, before the
+        first client connects
+        """
+        self.preload()
+        await self.broadcaster.start()
+        await self.broadcaster.report_connections()
+        self.connections_reporter.start()
+    
+    async def stop(self):
+        """ Unsubscribes and closes the redis connections of the application """
+        self.connections_reporter.stop()
+        await self.broadcaster.stop()
 
 
-class MainHandler(web.RequestHandler):
+class MainHandler(CachedFileHandler):
+    # the rendered page and its compressed variants, shared by the requests of the process
+    page = CachedFile(_map_index_page)
+    
+    @classmethod
+    def preload(cls, application: web.Application):
+        """ Renders and compresses the page at startup, the first requests are served from memory too """
+        cls.page.refresh(functools.partial(cls.render_page, application))
+    
+    @classmethod
+    def template_namespace(cls, application: web.Application) -> Dict[str, Any]:
+        """
+        Namespace of the page, built from the application only: one rendering is served to every client, so no
+        value of a request (handler, xsrf token, user, locale) may end up in it
+        """
+        settings = application.settings
+        locale = tornado.locale.get()
+        namespace = dict(
+            settings = settings,
+            locale = locale,
+            _ = locale.translate,
+            pgettext = locale.pgettext,
+            reverse_url = application.reverse_url,
+        )
+        if settings.get("static_path"):
+            static_handler = settings.get("static_handler_class", web.StaticFileHandler)
+            namespace["static_url"] = functools.partial(static_handler.make_static_url, settings)
+        return namespace
+    
+    @classmethod
+    def render_page(cls, application: web.Application, content: bytes) -> bytes:
+        """ Renders the page once for every version of the file instead of once per request """
+        settings = application.settings
+        loader = settings.get("template_loader")
+        if loader is None:
+            loader_options = dict()
+            if "autoescape" in settings:
+                loader_options["autoescape"] = settings["autoescape"]
+            if "template_whitespace" in settings:
+                loader_options["whitespace"] = settings["template_whitespace"]
+            loader = template.Loader(str(cls.page.path.parent), **loader_options)
+        page = template.Template(content, name = cls.page.path.name, loader = loader)
+        return page.generate(**cls.template_namespace(application))
     
     def head(self):
-        pass
+        self.serve(self.page, include_body = False, transform = functools.partial(self.render_page, self.application))
     
     def get(self):
-        logger.info(f"New request received: {repr(self.request)}")
-        self.render(str(_map_index_page))
+        logger.debug(f"New request received: {repr(self.request)}")
+        self.serve(self.page, transform = functools.partial(self.render_page, self.application))
 
 
 @click.group(
@@ -80,12 +187,93 @@ class MainHandler(web.RequestHandler):
     metavar = "<integer>",
     help = "Port that tornado server will listen to"
 )
+@click.option(
+    "--processes",
+    default = 1,
+    type = click.IntRange(0, None),
+    metavar = "<integer>",
+    help = "Number of server processes sharing the port, each with its own redis subscriber and clients "
+           "(0 starts one per CPU)"
+)
+@click.option(
+    "--redis-ip",
+    default = "127.0.0.1",
+    metavar = "<ip>",
+    help = "Redis-server ip address, where the proxy publishes the attacks"
+)
+@click.option(
+    "--redis-port",
+    default = 6379,
+    type = click.IntRange(1, 65535),
+    metavar = "<integer>",
+    help = "Redis-server port"
+)
+@click.option(
+    "--redis-socket",
+    default = None,
+    metavar = "<path>",
+    help = "Unix socket of a redis-server on the same host, used instead of --redis-ip and --redis-port"
+)
 @click.option(
     "--no-nginx",
     is_flag = True,
     metavar = "<switch>",
     help = "Disable NGINX integration for load balancing"
 )
+@click.option(
+    "-t",
+    "--transport",
+    default = "pubsub",
+    type = click.Choice(TRANSPORTS),
+    help = "Receive the attacks from the pub/sub channel or from the redis stream written by the proxy"
+)
+@click.option(
+    "--queue-limit",
+    default = 256,
+    type = click.IntRange(1, None),
+    metavar = "<integer>",
+    help = "Maximum number of frames queued for each client"
+)
+@click.option(
+    "--queue-policy",
+    default = "drop-oldest",
+    type = click.Choice(QUEUE_POLICIES),
+    help = "What to do when a client queue is full: drop the oldest frame, keep only the latest stats frame "
+           "or disconnect the client after --backpressure-timeout seconds"
+)
+@click.option(
+    "--backpressure-timeout",
+    default = 10.0,
+    type = click.FloatRange(0, None),
+    metavar = "<float>",
+    help = "Seconds a client may stall before being disconnected (disconnect policy)"
+)
+@click.option(
+    "--batch-interval",
+    default = 0.0,
+    type = click.FloatRange(0, None),
+    metavar = "<float>",
+    help = "Collect the attacks arriving within this many seconds into one write per client (0 disables batching)"
+)
+@click.option(
+    "--batch-size",
+    default = 64,
+    type = click.IntRange(1, None),
+    metavar = "<integer>",
+    help = "Send a batch as soon as it holds this many attacks"
+)
+@click.option(
+    "--batch-event",
+    is_flag = True,
+    metavar = "<switch>",
+    help = "Send each batch as a single 'batch' event whose data is a JSON array of attacks"
+)
+@click.option(
+    "--codec",
+    default = None,
+    type = click.Choice(available_codecs()),
+    help = f"JSON library of the statistics and metrics (default: {get_codec().name})"
+)
 @click.option(
     "-v",
     "--verbose",
@@ -94,24 +282,107 @@ class MainHandler(web.RequestHandler):
     help = "Enable verbose logging messages"
 )
 @click.pass_context
-def main(ctx, port, no_nginx, verbose):
+def main(ctx, port, processes, redis_ip, redis_port, redis_socket, no_nginx, transport, queue_limit, queue_policy,
+         backpressure_timeout, batch_interval, batch_size, batch_event, codec, verbose):
     # arguments are handled by click, with args=[] we only enable tornado's logging without parsing command line options
     parse_command_line(args = ["", f"--logging={'debug' if verbose else 'info'}"])
     
     logger.info(f"port: {port}")
+    logger.info(f"processes: {colorize(processes or f'{os.cpu_count()} (one per CPU)', 'gold_1')}")
+    logger.info(f"redis: {colorize(redis_socket or f'{redis_ip}:{redis_port}', 'gold_1')}")
     logger.info(f"no-nginx: {colorize(no_nginx and 'on' or 'off', 'gold_1')}")
+    logger.info(f"transport: {colorize(transport, 'gold_1')}")
+    logger.info(f"queue: {colorize(f'{queue_limit} frames, {queue_policy}', 'gold_1')}")
+    logger.info(
+        f"batching: {colorize(batch_interval and f'{batch_interval}s or {batch_size} attacks' or 'off', 'gold_1')}")
+    logger.info(f"codec: {colorize(use_codec(codec).name, 'gold_1')}")
     logger.info(f"verbose: {colorize(verbose and 'on' or 'off', 'gold_1')}")
     
     if no_nginx:
-        logger.info("Static content will be served from tornado instead of NGINX")
+        logger.info(
+            f"Static content will be served from tornado instead of NGINX, cached as {', '.join(['identity'] + ENCODINGS)}")
     
-    server = HTTPServer(Cybermap(), xheaders = True)
-    server.listen(port)
-    logger.info(f"Cybermap's HTTPServer started on port {port}")
+    # every viewer holds a socket, the default soft limit of open files is far below what a busy map needs
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    limit = hard
     try:
-        IOLoop.instance().start()
-    except KeyboardInterrupt:
-        IOLoop.instance().stop()
+        # an unlimited hard limit is still capped by the kernel
+        with open("/proc/sys/fs/nr_open") as f:
+            nr_open = int(f.read())
+        if hard == resource.RLIM_INFINITY or hard > nr_open:
+            limit = nr_open
+    except (OSError, ValueError):
+        if hard == resource.RLIM_INFINITY:
+            limit = max(soft, 65536)
+    if soft != resource.RLIM_INFINITY and soft < limit:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+        except (ValueError, OSError) as error:
+            logger.warning(f"Open files limit could not be raised from {soft} to {limit}: {error}")
+    
+    sockets = None
+    parent = os.getpid()
+    if processes != 1:
+        reuse_port = hasattr(socket, "SO_REUSEPORT")
+        if not reuse_port:
+            # the processes accept from the sockets bound here
+            sockets = bind_sockets(port)
+        # the parent exits quietly, its children notice and stop gracefully
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda signum, frame: sys.exit(0))
+        # returns in the children only, the parent restarts children that crash until they all exit
+        fork_processes(processes)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        logger.info(f"Server process {task_id()} started with pid {os.getpid()}")
+        if reuse_port:
+            # one listening socket per process, the kernel spreads the new connections evenly among them
+            sockets = bind_sockets(port, reuse_port = True)
+    
+    # created after the fork, every process has its own redis subscriber and clients
+    broadcaster = Broadcaster(
+        address = redis_socket or (redis_ip, redis_port),
+        transport = transport,
+        batch_interval = batch_interval,
+        batch_size = batch_size,
+        batch_event = batch_event
+    )
+    application = Cybermap(
+        broadcaster = broadcaster,
+        queue_limit = queue_limit,
+        queue_policy = queue_policy,
+        backpressure_timeout = backpressure_timeout,
+        no_nginx = no_nginx
+    )
+    server = HTTPServer(application, xheaders = True)
+    if sockets is None:
+        server.listen(port)
+    else:
+        server.add_sockets(sockets)
+    
+    loop = IOLoop.current()
+    # connect latency and redis connections do not depend on the clients, they share what is opened here
+    loop.run_sync(application.start)
+    logger.info(f"Cybermap's HTTPServer started on port {port}")
+    
+    async def shutdown():
+        logger.info("Stopping Cybermap's HTTPServer")
+        server.stop()
+        await application.stop()
+        loop.stop()
+    
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.asyncio_loop.add_signal_handler(signum, loop.add_callback, shutdown)
+    
+    if processes != 1:
+        def watch_parent():
+            if os.getppid() != parent:
+                watcher.stop()
+                loop.add_callback(shutdown)
+        
+        watcher = PeriodicCallback(watch_parent, callback_time = 1000)
+        watcher.start()
+    loop.start()
 
 
 if __name__ == "__main__":
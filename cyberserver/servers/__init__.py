@@ -1,7 +1,7 @@
 from .utilities import *
 from .attacks_generator import AttacksGenerator
 from .proxy import Proxy
-from .handler import SSEHandler
+from .handler import SSEHandler, Broadcaster
 
 __all__ = [
     # "get_console_logger",
@@ -13,6 +13,7 @@ __all__ = [
     # "confirmation",
     # "get_time",
     "SSEHandler",
+    "Broadcaster",
     "AttacksGenerator",
     "Proxy",
     "utilities"
@@ -29,6 +29,16 @@ class AttacksGenerator(object):
             method: str = "random",
             interval: float = 0.1,
             filepath: Optional[Union[pathlib.Path, str]] = None,
+            transport: str = "pubsub",
+            stream_maxlen: int = 10000,
+            wire: str = "json",
+            publish_batch_size: int = 64,
+            publish_deadline: float = 0.01,
+            redis_ip: str = "127.0.0.1",
+            redis_port: int = 6379,
+            redis_socket: Optional[str] = None,
+            redis_pool_size: int = 64,
+            redis_health_check: float = 30,
             
             silent: Optional[bool] = None,
             script_mode: Optional[bool] = None,
@@ -81,13 +91,36 @@ class AttacksGenerator(object):
         self.channel: str = channel
         self.interval: float = interval
         
+        if transport not in utilities.TRANSPORTS:
+            raise ValueError(f"transport {transport} is not available. Available: {','.join(utilities.TRANSPORTS)}")
+        self.transport: str = transport
+        self.stream_maxlen: int = stream_maxlen
+        
+        if wire not in utilities.WIRE_FORMATS:
+            raise ValueError(f"wire format {wire} is not available. Available: {','.join(utilities.WIRE_FORMATS)}")
+        self.wire: str = wire
+        
         # file methods
         self.filepath: pathlib.Path = filepath
         
         self.silent: bool = silent
         self.verbose: bool = verbose
         self.script_mode: bool = script_mode
-        self.redis_watcher: utilities.RedisWatcher = utilities.RedisWatcher(silent = self.silent)
+        self.redis_watcher: utilities.RedisWatcher = utilities.RedisWatcher(
+            ip = redis_ip,
+            port = redis_port,
+            silent = self.silent,
+            unix_socket = redis_socket,
+            max_connections = redis_pool_size,
+            health_check_interval = redis_health_check
+        )
+        self.publisher: utilities.PublishBatcher = utilities.PublishBatcher(
+            self.redis_watcher.server,
+            batch_size = publish_batch_size,
+            deadline = publish_deadline,
+            transport = self.transport,
+            stream_maxlen = self.stream_maxlen
+        )
         self.ips_forged: int = 0
         
         # initiation
@@ -106,9 +139,14 @@ class AttacksGenerator(object):
             f"{utilities.colorize(self.ips_to_generate if self.ips_to_generate != INFINITE else '∞', 'gold_1')}"
         )
         self._logger.info(
-            f"Publishing to channel "
+            f"Publishing to {'stream' if self.transport == 'streams' else 'channel'} "
             f"{utilities.colorize(self.channel, 'gold_1')}"
         )
+        self._logger.info(f"Wire format {utilities.colorize(self.wire, 'gold_1')}")
+        self._logger.info(
+            f"Publishing batches of {utilities.colorize(publish_batch_size, 'gold_1')} attacks "
+            f"or every {utilities.colorize(publish_deadline, 'gold_1')} seconds"
+        )
         self._logger.info(f"Publishing interval {utilities.colorize(self.interval, 'gold_1')} seconds")
         self._logger.info(f"Silent mode {utilities.colorize(self.silent and 'on' or 'off', 'gold_1')}")
         self._logger.info(f"Script mode {utilities.colorize(self.script_mode and 'on' or 'off', 'gold_1')}")
@@ -126,9 +164,18 @@ class AttacksGenerator(object):
     def __del__(self):
         if not self.silent:
             sys.stdout.write("\033[1000D\033[K")
-            self._logger.info(f"Stopped generator. Total IPs generated: {utilities.colorize(self.ips_forged)}")
+            self._logger.info(
+                f"Stopped generator. Total IPs generated: {utilities.colorize(self.ips_forged)} "
+                f"[{utilities.colorize(f'{self.publisher.rate():.1f}', 'gold_1')} msg/s]"
+            )
     
     def random(self):
+        try:
+            self.publish_random()
+        finally:
+            self.publisher.close()
+    
+    def publish_random(self):
         while self.ips_to_generate == INFINITE or self.ips_forged < self.ips_to_generate:
             port = choice(list(self.ports.keys()))
             
@@ -144,20 +191,22 @@ class AttacksGenerator(object):
                 'type': self.ports[port],
                 'cve': f"CVE:{randrange(1997, 2019)}:{randrange(1, 400)}"
             }
-            json_data = json.dumps(data)
-            self.redis_watcher.server.publish(channel = self.channel, message = json_data)
+            self.publisher.publish(self.channel, utilities.encode_attack(data, wire = self.wire))
             self.ips_forged += 1
             self._logger.info(
                 f"Published random IP "
-                f"[{utilities.colorize(f'{self.ips_forged}', 'gold_1')}]"
+                f"[{utilities.colorize(f'{self.ips_forged}', 'gold_1')}] "
+                f"[{utilities.colorize(f'{self.publisher.rate():.1f}', 'gold_1')} msg/s]"
             )
             
-            self._logger.debug(f"{json.dumps(data, indent = 4)}")
+            if self._logger.isEnabledFor(logging.DEBUG):
+                self._logger.debug(f"{json.dumps(data, indent = 4)}")
             
             if not self.script_mode and not self.silent:
                 print("\033[A\033[K", end = '')
             
-            time.sleep(self.interval)
+            if self.interval:
+                time.sleep(self.interval)
     
     @staticmethod
     def ipv4() -> str:
@@ -254,8 +303,26 @@ class AttacksGenerator(object):
     "--interval",
     default = 0.05,
     metavar = "Float",
-    type = click.FloatRange(0.05, 100),
-    help = "Interval between each publication"
+    type = click.FloatRange(0, 100),
+    help = "Interval between each publication, 0 publishes as fast as possible"
+)
+# endregion
+# region transport option
+@click.option(
+    "-t",
+    "--transport",
+    default = "pubsub",
+    type = click.Choice(utilities.TRANSPORTS),
+    help = "Publish to a pub/sub channel or append to a redis stream"
+)
+# endregion
+# region stream-maxlen option
+@click.option(
+    "--stream-maxlen",
+    default = 10000,
+    metavar = "integer",
+    type = click.IntRange(1, None),
+    help = "Approximate number of attacks kept in the stream"
 )
 # endregion
 # region autostart option
@@ -267,6 +334,48 @@ class AttacksGenerator(object):
     help = "Immediately start publishing generated attacks"
 )
 # endregion
+# region wire option
+@click.option(
+    "--wire",
+    default = "json",
+    type = click.Choice(utilities.WIRE_FORMATS),
+    help = "Publish the attacks as JSON or as compact binary records, the proxy reads both"
+)
+# endregion
+# region publish-batch-size option
+@click.option(
+    "--publish-batch-size",
+    default = 64,
+    metavar = "integer",
+    type = click.IntRange(1, None),
+    help = "Attacks published in one redis pipeline, 1 publishes every attack on its own"
+)
+# endregion
+# region publish-deadline option
+@click.option(
+    "--publish-deadline",
+    default = 0.01,
+    metavar = "Float",
+    type = click.FloatRange(0, None),
+    help = "Seconds an attack may wait for its publishing batch to fill up"
+)
+# endregion
+# region redis-socket option
+@click.option(
+    "--redis-socket",
+    default = None,
+    metavar = "string",
+    help = "Unix socket of a redis-server on the same host"
+)
+# endregion
+# region codec option
+@click.option(
+    "--codec",
+    default = None,
+    type = click.Choice(utilities.available_codecs()),
+    help = f"JSON library of the attacks (default: {utilities.get_codec().name})"
+)
+# endregion
 # region verbose option
 @click.option(
     "--verbose",
@@ -294,14 +403,24 @@ class AttacksGenerator(object):
 )
 # endregion
 @click.pass_context
-def main(ctx, channel: str, interval: float, verbose: bool, silent: bool, script_mode: bool, autostart: bool):
+def main(ctx, channel: str, interval: float, transport: str, stream_maxlen: int, wire: str,
+         publish_batch_size: int, publish_deadline: float, redis_socket: Optional[str], codec: Optional[str],
+         verbose: bool, silent: bool, script_mode: bool, autostart: bool):
     """
     Custom command line utility to generate cyberattacks for publishing to a redis channel
     """
     
+    utilities.use_codec(codec)
+    
     ctx.obj = {
         "channel": channel,
         "interval": interval,
+        "transport": transport,
+        "stream_maxlen": stream_maxlen,
+        "wire": wire,
+        "publish_batch_size": publish_batch_size,
+        "publish_deadline": publish_deadline,
+        "redis_socket": redis_socket,
         "verbose": verbose,
         "silent": silent,
         "script_mode": script_mode,
@@ -335,6 +454,12 @@ def random(ctx, ips_to_forge):
         channel = ctx.obj["channel"],
         ips_to_generate = ips_to_forge,
         interval = ctx.obj["interval"],
+        transport = ctx.obj["transport"],
+        stream_maxlen = ctx.obj["stream_maxlen"],
+        wire = ctx.obj["wire"],
+        publish_batch_size = ctx.obj["publish_batch_size"],
+        publish_deadline = ctx.obj["publish_deadline"],
+        redis_socket = ctx.obj["redis_socket"],
         silent = ctx.obj["silent"],
         script_mode = ctx.obj["script_mode"]
     )
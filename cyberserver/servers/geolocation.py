@@ -0,0 +1,448 @@
+import os
+import sys
+import json
+import time
+import socket
+import bisect
+import pathlib
+import tempfile
+import subprocess
+from array import array
+from collections import OrderedDict
+from typing import Optional, Dict, List, Tuple, Any, Callable, Union
+
+import maxminddb
+
+from cyberserver.servers.utilities.codec import dumps
+
+
+# reader modes selectable from the command line
+DATABASE_MODES: Dict[str, int] = {
+    "mmap": maxminddb.MODE_MMAP,
+    "memory": maxminddb.MODE_MEMORY,
+    "file": maxminddb.MODE_FILE,
+    "auto": maxminddb.MODE_AUTO,
+    "c-ext": maxminddb.MODE_MMAP_EXT,
+}
+
+
+def open_reader(database: Union[str, pathlib.Path], mode: str = "mmap") -> maxminddb.reader.Reader:
+    """
+    Opens a MaxMind database
+    
+    :param mode: one of DATABASE_MODES. mmap maps the file read-only, so every process that opens the same
+                 database shares one copy of it in the page cache. c-ext uses the C extension over the same mapping
+    :raise ValueError: if mode is not defined or its reader is not available
+    """
+    if mode not in DATABASE_MODES:
+        raise ValueError(f"Mode: {mode} is not defined. Use one of the following [{','.join(DATABASE_MODES)}]")
+    return maxminddb.open_database(str(database), mode = DATABASE_MODES[mode])
+
+
+def clean_ip(ip_info):
+    """Create clean dictionary using unclean db dictionary contents"""
+    if not ip_info:
+        return dict()
+    
+    selected = {
+        "continent": ip_info.get("continent", dict()).get("names", dict()).get("en", None),
+        "continent_code": ip_info.get("continent", dict()).get("code", None),
+        "country": ip_info.get("country", dict()).get("names", dict()).get("en", None),
+        "city": ip_info.get("city", dict()).get("names", dict()).get("en", None),
+        "iso_code": ip_info.get("country", dict()).get("iso_code", None),
+        "latitude": ip_info.get("location", dict()).get("latitude", None),
+        "longitude": ip_info.get("location", dict()).get("longitude", None),
+    }
+    
+    return selected
+
+
+def located(clean_ip_info: Dict) -> Optional[Dict]:
+    """The cleaned record if it can be placed on the map, None otherwise"""
+    if not clean_ip_info.get("latitude") and not clean_ip_info.get("longitude"):
+        return None
+    return clean_ip_info
+
+
+def ip_to_int(ip: str) -> Tuple[int, int]:
+    """
+    Integer value of an IP address
+    
+    :return: the value and the number of bits of the address (32 or 128)
+    :raise ValueError: if ip is not a valid IPv4 or IPv6 address
+    """
+    try:
+        return int.from_bytes(socket.inet_pton(socket.AF_INET, ip), "big"), 32
+    except OSError:
+        pass
+    try:
+        return int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), "big"), 128
+    except OSError:
+        raise ValueError(f"'{ip}' does not appear to be an IPv4 or IPv6 address")
+
+
+class GeoCache(object):
+    """
+    Bounded LRU cache of cleaned geolocation records, in front of a MaxMind reader.
+    
+    Records are keyed by the network MaxMind returns them for (get_with_prefix_len), so one lookup serves every
+    address of that network. The networks of a MaxMind database are disjoint, so a lookup probes the cache once
+    for each prefix length seen so far and at most one network can match.
+    """
+    
+    def __init__(self, reader: maxminddb.reader.Reader, size: int = 65536, ttl: float = 0):
+        """
+        :param reader: MaxMind database reader to look up misses
+        :param size: maximum number of cached networks
+        :param ttl: seconds a network stays cached, 0 keeps it until evicted
+        """
+        if size < 1:
+            raise ValueError("size of the geolocation cache must be a positive integer")
+        
+        self.reader = reader
+        self.size: int = size
+        self.ttl: float = ttl
+        # (bits, prefix length, network) -> (expiration time, cleaned record or None)
+        self.records: "OrderedDict[Tuple[int, int, int], Tuple[float, Optional[Dict]]]" = OrderedDict()
+        # prefix lengths of the cached networks per address size, longest first
+        self.prefix_lengths: Dict[int, List[int]] = {32: list(), 128: list()}
+        self.hits: int = 0
+        self.misses: int = 0
+    
+    def get(self, ip: str) -> Optional[Dict]:
+        """
+        Cleaned record of an IP address
+        
+        :return: the record or None if the address can not be placed on the map
+        :raise ValueError: if ip is not a valid IP address
+        """
+        value, bits = ip_to_int(ip)
+        now = time.monotonic() if self.ttl else 0.0
+        
+        for prefix_len in self.prefix_lengths[bits]:
+            key = (bits, prefix_len, value >> (bits - prefix_len))
+            entry = self.records.get(key)
+            if entry is None:
+                continue
+            
+            expiration, record = entry
+            if self.ttl and expiration < now:
+                del self.records[key]
+                break
+            
+            self.records.move_to_end(key)
+            self.hits += 1
+            return record
+        
+        self.misses += 1
+        ip_info, prefix_len = self.reader.get_with_prefix_len(ip)
+        record = located(clean_ip(ip_info))
+        self.store(bits, prefix_len, value, record, now)
+        return record
+    
+    def store(self, bits: int, prefix_len: int, value: int, record: Optional[Dict], now: float = 0.0):
+        key = (bits, prefix_len, value >> (bits - prefix_len))
+        self.records[key] = (now + self.ttl, record)
+        self.records.move_to_end(key)
+        
+        if prefix_len not in self.prefix_lengths[bits]:
+            self.prefix_lengths[bits] = sorted(self.prefix_lengths[bits] + [prefix_len], reverse = True)
+        
+        while len(self.records) > self.size:
+            self.records.popitem(last = False)
+    
+    def clear(self):
+        self.records.clear()
+        self.prefix_lengths = {32: list(), 128: list()}
+    
+    def addresses(self) -> List[str]:
+        """ First address of every cached network, most recently used last """
+        addresses = list()
+        # copied in one step, the cache may be in use by another thread
+        for bits, prefix_len, network in list(self.records):
+            packed = (network << (bits - prefix_len)).to_bytes(bits // 8, "big")
+            addresses.append(socket.inet_ntop(socket.AF_INET if bits == 32 else socket.AF_INET6, packed))
+        return addresses
+    
+    def warm(self, addresses: List[str]):
+        """ Looks up addresses ahead of time, e.g. the addresses of the cache of a previous database """
+        for ip in addresses:
+            self.get(ip)
+        self.hits = 0
+        self.misses = 0
+    
+    def counters(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.records),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+    
+    def __len__(self):
+        return len(self.records)
+
+
+class FragmentCache(object):
+    """
+    Serialized JSON of cleaned records, for messages assembled from bytes.
+    
+    GeoCache and PrefixIndex return the same record object for every address of a network, so fragments are keyed
+    by the identity of the records. An entry keeps its record alive, so the id of a cached record is never reused
+    by another object, and the cache is emptied once full instead of tracking the least recently used records.
+    """
+    
+    def __init__(self, size: int = 65536):
+        self.size: int = size
+        # id of the record -> (record, fragment)
+        self.fragments: Dict[int, Tuple[Dict, bytes]] = dict()
+    
+    def get(self, record: Dict) -> bytes:
+        entry = self.fragments.get(id(record))
+        if entry is not None and entry[0] is record:
+            return entry[1]
+        
+        fragment = dumps(record)
+        if len(self.fragments) >= self.size:
+            self.fragments.clear()
+        self.fragments[id(record)] = (record, fragment)
+        return fragment
+    
+    def clear(self):
+        self.fragments.clear()
+    
+    def __len__(self):
+        return len(self.fragments)
+
+
+class PrefixIndex(object):
+    """
+    Every IPv4 network of a MaxMind database that can be placed on the map, flattened into sorted arrays of
+    network starts and ends with the index of the network's record in a deduplicated table of cleaned records.
+    
+    A lookup is a bisection of the starts array. Building the index walks the whole tree once, so it is meant
+    to be saved next to the database and loaded on the following startups.
+    """
+    
+    FORMAT = 1
+    TYPECODE = "I" if array("I").itemsize == 4 else "L"
+    
+    def __init__(
+            self,
+            starts: array,
+            ends: array,
+            indices: array,
+            records: List[Dict],
+            build_epoch: int,
+            fallback: Optional[Callable[[str], Optional[Dict]]] = None
+    ):
+        """
+        :param fallback: lookup of the addresses outside of the index (IPv6), None places them nowhere
+        """
+        self.starts: array = starts
+        self.ends: array = ends
+        self.indices: array = indices
+        self.records: List[Dict] = records
+        self.build_epoch: int = build_epoch
+        self.fallback: Optional[Callable[[str], Optional[Dict]]] = fallback
+    
+    @classmethod
+    def build(cls, database: Union[str, pathlib.Path]) -> "PrefixIndex":
+        """ Walks the IPv4 part of the database tree """
+        reader = open_reader(database, mode = "mmap")
+        try:
+            metadata = reader.metadata()
+            node_count = metadata.node_count
+            
+            # IPv4 addresses live under ::/96 of an IPv6 tree
+            node = 0
+            if metadata.ip_version == 6:
+                for _ in range(96):
+                    if node >= node_count:
+                        break
+                    node = reader._read_node(node, 0)
+            
+            starts, ends, indices = array(cls.TYPECODE), array(cls.TYPECODE), array(cls.TYPECODE)
+            records: List[Dict] = list()
+            by_pointer: Dict[int, Optional[int]] = dict()
+            by_content: Dict[Tuple, int] = dict()
+            
+            # depth first with the left child on top, so networks come out in ascending order
+            stack: List[Tuple[int, int, int]] = [(node, 0, 0)]
+            while stack:
+                node, depth, network = stack.pop()
+                if node < node_count:
+                    if depth < 32:
+                        stack.append((reader._read_node(node, 1), depth + 1, (network << 1) | 1))
+                        stack.append((reader._read_node(node, 0), depth + 1, network << 1))
+                    continue
+                
+                if node == node_count:  # no data for this network
+                    continue
+                
+                if node not in by_pointer:
+                    record = located(clean_ip(reader._resolve_data_pointer(node)))
+                    if record is None:
+                        by_pointer[node] = None
+                    else:
+                        content = tuple(record.values())
+                        if content not in by_content:
+                            by_content[content] = len(records)
+                            records.append(record)
+                        by_pointer[node] = by_content[content]
+                
+                index = by_pointer[node]
+                if index is None:
+                    continue
+                
+                start = network << (32 - depth)
+                end = start + (1 << (32 - depth)) - 1
+                if ends and ends[-1] + 1 == start and indices[-1] == index:
+                    ends[-1] = end  # adjacent networks of the same record become one
+                else:
+                    starts.append(start)
+                    ends.append(end)
+                    indices.append(index)
+            
+            return cls(starts, ends, indices, records, build_epoch = metadata.build_epoch)
+        finally:
+            reader.close()
+    
+    @classmethod
+    def load(cls, path: Union[str, pathlib.Path], database: Union[str, pathlib.Path]) -> Optional["PrefixIndex"]:
+        """
+        Loads an index saved for database
+        
+        :return: the index or None if there is no saved index or it was built from another database
+        """
+        path = pathlib.Path(path)
+        if not path.exists():
+            return None
+        
+        with open_reader(database, mode = "mmap") as reader:
+            build_epoch = reader.metadata().build_epoch
+        
+        with path.open(mode = "rb") as f:
+            try:
+                header = json.loads(f.readline())
+            except ValueError:
+                return None
+            
+            if header.get("format") != cls.FORMAT or header.get("build_epoch") != build_epoch \
+                    or header.get("itemsize") != array(cls.TYPECODE).itemsize \
+                    or header.get("byteorder") != sys.byteorder:
+                return None
+            
+            arrays = list()
+            for _ in range(3):
+                values = array(cls.TYPECODE)
+                values.fromfile(f, header["networks"])
+                arrays.append(values)
+            records = json.loads(f.read())
+        
+        return cls(*arrays, records = records, build_epoch = build_epoch)
+    
+    @classmethod
+    def build_in_subprocess(cls, database: Union[str, pathlib.Path], path: Union[str, pathlib.Path]):
+        """
+        Builds the index of database and saves it to path in a python subprocess, the tree walk does not compete
+        for the GIL of the calling process. A subprocess rather than multiprocessing, the proxy workers are daemonic
+        processes, which may not have children.
+        
+        :raise OSError: if the index could not be built or saved
+        """
+        command = "import sys; from cyberserver.servers.geolocation import PrefixIndex; " \
+                  "PrefixIndex.build(sys.argv[1]).save(sys.argv[2])"
+        environment = dict(os.environ, PYTHONPATH = os.pathsep.join(entry for entry in sys.path if entry))
+        result = subprocess.run(
+            [sys.executable, "-c", command, str(database), str(path)],
+            env = environment,
+            stdout = subprocess.DEVNULL,
+            stderr = subprocess.PIPE
+        )
+        if result.returncode != 0:
+            lines = result.stderr.decode("utf-8", errors = "replace").strip().splitlines()
+            error = lines[-1] if lines else f"exit code {result.returncode}"
+            raise OSError(f"Network index of {database} could not be built: {error}")
+    
+    @classmethod
+    def open(cls, database: Union[str, pathlib.Path], path: Optional[Union[str, pathlib.Path]] = None,
+             logger = None, in_process: bool = True) -> "PrefixIndex":
+        """
+        Loads the saved index of database or builds and saves it
+        
+        :param path: file of the saved index. Default: the database path with an .index suffix
+        :param in_process: build the index in this process, otherwise in a subprocess and load the file it
+                           saved, e.g. while this process is serving
+        :raise OSError: if in_process is False and the index could not be built
+        """
+        path = pathlib.Path(path) if path else pathlib.Path(f"{database}.index")
+        index = cls.load(path, database)
+        if index is not None:
+            return index
+        
+        if logger:
+            logger.info(f"Building the network index of {database}, this happens once per database")
+        if not in_process:
+            try:
+                cls.build_in_subprocess(database, path)
+            except OSError:
+                # the index is loaded from a temporary file when it cannot be saved next to the database
+                with tempfile.TemporaryDirectory() as folder:
+                    temporary = pathlib.Path(folder) / path.name
+                    cls.build_in_subprocess(database, temporary)
+                    index = cls.load(temporary, database)
+            else:
+                index = cls.load(path, database)
+            if index is None:
+                raise OSError(f"Network index of {database} was built from another version of the database")
+            return index
+        
+        index = cls.build(database)
+        try:
+            index.save(path)
+        except OSError as error:
+            if logger:
+                logger.warning(f"Network index could not be saved to {path}: {error}")
+        return index
+    
+    def save(self, path: Union[str, pathlib.Path]):
+        """ Writes the index to a temporary file that replaces path once complete """
+        path = pathlib.Path(path)
+        header = {
+            "format": self.FORMAT,
+            "build_epoch": self.build_epoch,
+            "networks": len(self.starts),
+            "records": len(self.records),
+            "itemsize": self.starts.itemsize,
+            "byteorder": sys.byteorder,
+        }
+        
+        temporary = path.with_name(f".{path.name}.tmp")
+        with temporary.open(mode = "wb") as f:
+            f.write(json.dumps(header).encode("utf-8") + b"\n")
+            self.starts.tofile(f)
+            self.ends.tofile(f)
+            self.indices.tofile(f)
+            f.write(json.dumps(self.records).encode("utf-8"))
+        os.replace(temporary, path)
+    
+    def get(self, ip: str) -> Optional[Dict]:
+        """
+        Cleaned record of an IP address
+        
+        :return: the record or None if the address can not be placed on the map
+        :raise ValueError: if ip is not a valid IP address
+        """
+        value, bits = ip_to_int(ip)
+        if bits != 32:
+            return self.fallback(ip) if self.fallback else None
+        
+        position = bisect.bisect_right(self.starts, value) - 1
+        if position < 0 or self.ends[position] < value:
+            return None
+        return self.records[self.indices[position]]
+    
+    def __len__(self):
+        return len(self.starts)
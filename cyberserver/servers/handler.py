@@ -1,17 +1,24 @@
 # encoding: utf-8
-import uuid
+import re
+import asyncio
+import itertools
+from collections import deque
 from pprint import pprint
-from typing import Optional, List, Dict, Any, Union, Set
+from typing import Optional, List, Dict, Any, Union, Set, Tuple, Deque
 
 import tornado.web
 import tornado.escape
 import tornado.ioloop
 import tornado.gen
+import tornado.locks
 import tornado.concurrent
+import tornado.iostream
 from tornado.ioloop import PeriodicCallback
 
+import os
 import time
 import json
+import socket
 import hashlib
 import logging
 
@@ -20,25 +27,427 @@ import aioredis.pubsub
 
 from tornado.httputil import HTTPConnection
 
+from .utilities.ring_buffer import RingBuffer
+from .utilities.codec import dumps, loads
+from .utilities.redis_watcher import TRANSPORTS, RedisWatcher
+
 
 logger = logging.getLogger()
 
 CHANNEL = 'cyberattacks'
 STATS_CHANNEL = 'cyberstats'
 
+# what a client queue does with a new frame when it is already full
+QUEUE_POLICIES = ["drop-oldest", "coalesce", "disconnect"]
+
+# the proxy serializes the event id as the first key of every attack
+EVENT_ID_PATTERN = re.compile(rb'^\{\s*"id"\s*:\s*"([^"]+)"')
+
+STREAM_ID_PATTERN = re.compile(r'^\d+-\d+$')
+
+
+def stream_position(entry_id: str) -> Tuple[int, int]:
+    """ Order of an entry in its stream, ids compare as (milliseconds, sequence) """
+    milliseconds, _, sequence = entry_id.partition("-")
+    return int(milliseconds), int(sequence)
+
+# in delta mode the proxy serializes the sequence number and the kind of the statistics first
+STATS_KIND_PATTERN = re.compile(rb'^\{\s*"seq"\s*:\s*(\d+)\s*,\s*"kind"\s*:\s*"(\w+)"')
+
+# redis hash of the clients connected to each SSE server process, as process -> [clients, report time]
+CONNECTIONS_KEY = "cybermap:connections"
+
+
+class Broadcaster(object):
+    """
+    Process-wide subscriber of the redis channels that feed the /events connections.
+    
+    Each message is received once from redis, formatted once as an SSE frame and the very same bytes are
+    handed to every connected client, so the cost of an event no longer grows with the number of clients.
+    
+    With the streams transport the attacks are read from the cyberattacks stream and the stream entry ids are
+    used as event ids, so clients that fell out of the cache are replayed from the stream itself.
+    """
+    
+    def __init__(
+            self,
+            address: Union[Tuple[str, int], str] = ("127.0.0.1", 6379),
+            channels_names: Optional[List[str]] = None,
+            cache_limit: int = 200,
+            batch_interval: float = 0.0,
+            batch_size: int = 64,
+            batch_event: bool = False,
+            transport: str = "pubsub",
+            replay_limit: int = 10000
+    ):
+        if transport not in TRANSPORTS:
+            raise ValueError(f"Transport {transport} is not defined. Use one of [{','.join(TRANSPORTS)}]")
+        
+        self.address = address
+        self.transport: str = transport
+        self.replay_limit: int = replay_limit
+        self.channels_names: List[str] = channels_names or [CHANNEL, STATS_CHANNEL]
+        self.clients: Dict[str, "SSEHandler"] = dict()
+        # the latest attack frames, so reconnecting clients can get what they missed
+        self.cache = RingBuffer(size = cache_limit)
+        self.redis_pool: Optional[aioredis.Redis] = None
+        self.receiver: Optional[aioredis.pubsub.Receiver] = None
+        # blocking XREADs get their own connection, the pool would queue every other command behind them
+        self.stream_reader: Optional[aioredis.Redis] = None
+        self.tasks: List[asyncio.Future] = list()
+        self._lock = tornado.locks.Lock()
+        # ids for messages of producers that do not assign one
+        self.epoch = int(time.time())
+        self.event_counter = itertools.count(1)
+        
+        # batching of attack frames, disabled when batch_interval is 0
+        self.batch_interval: float = batch_interval
+        self.batch_size: int = batch_size
+        self.batch_event: bool = batch_event
+        self.batch: List[Tuple[str, bytes, bytes]] = list()  # (id, data, frame) of the attacks not yet sent
+        self.batch_timeout: Optional[object] = None
+        
+        # the latest statistics, with the deltas received since the latest snapshot applied
+        self.stats: Optional[Dict[str, Any]] = None
+        self.stats_frame: Optional[bytes] = None
+        
+        # field of this process in the connections hash
+        self.process_name: str = f"{socket.gethostname()}:{os.getpid()}"
+    
+    @property
+    def running(self) -> bool:
+        return bool(self.tasks) and not any(task.done() for task in self.tasks)
+    
+    async def start(self):
+        """ Connects to redis and subscribes to the channels, once for the whole process. """
+        async with self._lock:
+            if self.running:
+                return
+            
+            if not self.redis_pool:
+                try:
+                    # This is the IP address of the Proxy, or the path of its unix socket
+                    self.redis_pool = await RedisWatcher.async_pool(self.address)
+                except Exception:
+                    logger.exception("Could not connect to Redis server.")
+                    raise
+            
+            for task in self.tasks:
+                task.cancel()
+            self.tasks = list()
+            
+            channels_names = self.channels_names
+            if self.transport == "streams" and CHANNEL in channels_names:
+                channels_names = [name for name in channels_names if name != CHANNEL]
+                if not self.stream_reader:
+                    self.stream_reader = await aioredis.create_redis(address = self.address)
+                self.tasks.append(asyncio.ensure_future(self.listen_stream()))
+                logger.info(f"Broadcaster is reading the {CHANNEL} stream")
+            
+            if channels_names:
+                self.receiver = aioredis.pubsub.Receiver()
+                await self.redis_pool.subscribe(*[self.receiver.channel(name = name) for name in channels_names])
+                self.tasks.append(asyncio.ensure_future(self.listen()))
+                logger.info(f"Broadcaster is listening for messages in channels [{','.join(channels_names)}]")
+    
+    async def listen(self):
+        async for channel, msg in self.receiver.iter():
+            assert isinstance(channel, aioredis.pubsub.AbcChannel)
+            try:
+                self.dispatch(channel.name.decode("utf-8"), msg)
+            except Exception:
+                logger.exception(f"Could not dispatch message from channel {channel.name}")
+    
+    async def listen_stream(self, count: int = 512, timeout: int = 5000):
+        """ Reads the attacks appended to the stream after the broadcaster started """
+        # "$" would be resolved again by every XREAD and skip the entries appended between two reads
+        last_id: Optional[str] = None
+        while True:
+            try:
+                if last_id is None:
+                    latest = await self.stream_reader.xrevrange(CHANNEL, count = 1)
+                    last_id = latest[0][0].decode("utf-8") if latest else "0-0"
+                entries = await self.stream_reader.xread([CHANNEL], timeout = timeout, count = count, latest_ids = [last_id])
+            except aioredis.errors.RedisError:
+                logger.exception(f"Could not read the {CHANNEL} stream")
+                await asyncio.sleep(1)
+                continue
+            
+            for _, entry_id, fields in entries:
+                last_id = entry_id.decode("utf-8")
+                msg = fields.get(b"data")
+                if msg is None:
+                    continue
+                try:
+                    self.dispatch(CHANNEL, msg, msg_id = last_id)
+                except Exception:
+                    logger.exception(f"Could not dispatch entry {last_id} of the {CHANNEL} stream")
+    
+    @staticmethod
+    def format_attack(msg_id: str, msg: bytes) -> bytes:
+        return b"\nevent: message\ndata: " + msg + b"\nid: " + msg_id.encode() + b"\n\n"
+    
+    def dispatch(self, channel_name: str, msg: bytes, msg_id: Optional[str] = None):
+        """ Formats a message once and pushes the resulting frame to every connected client. """
+        if channel_name == CHANNEL:
+            if msg_id is None:
+                msg_id = self.event_id(msg)
+            sse = self.format_attack(msg_id, msg)
+            self.cache.append(msg_id, sse)
+            
+            if self.batch_interval <= 0:
+                self.fan_out(sse, kind = "message", entries = [(msg_id, msg, sse)])
+                return
+            
+            self.batch.append((msg_id, msg, sse))
+            if len(self.batch) >= self.batch_size:
+                self.flush_batch()
+            elif self.batch_timeout is None:
+                self.batch_timeout = tornado.ioloop.IOLoop.current().call_later(self.batch_interval, self.flush_batch)
+        elif channel_name == STATS_CHANNEL:
+            # attacks received before the stats go out first so clients see events in order
+            self.flush_batch()
+            # stats frames carry no id so the Last-Event-ID of a client always points to a cached attack
+            if self.update_stats(msg) == "delta":
+                self.fan_out(b"\nevent: stats-delta\ndata: " + msg + b"\n\n", kind = "stats-delta")
+            else:
+                self.fan_out(self.stats_frame, kind = "stats")
+    
+    def update_stats(self, msg: bytes) -> str:
+        """
+        Keeps the latest statistics up to date with a message of the stats channel
+        
+        :return: the kind of the message, snapshot or delta
+        """
+        match = STATS_KIND_PATTERN.match(msg)
+        if not match or match.group(2) != b"delta":
+            # full statistics are kept as they are, only snapshots followed by deltas are decoded
+            self.stats = loads(msg) if match else None
+            self.stats_frame = b"\nevent: stats\ndata: " + msg + b"\n\n"
+            return "snapshot"
+        
+        seq = int(match.group(1))
+        if self.stats is None or self.stats.get("seq") != seq - 1:
+            if self.stats_frame is not None:
+                logger.warning(f"Statistics before delta {seq} were missed, waiting for the next snapshot")
+            self.stats = None
+            self.stats_frame = None
+            return "delta"
+        
+        self.apply_stats_delta(self.stats, loads(msg))
+        # encoded again for the next client that connects
+        self.stats_frame = None
+        return "delta"
+    
+    @staticmethod
+    def apply_stats_delta(stats: Dict[str, Any], delta: Dict[str, Any]):
+        stats["seq"] = delta["seq"]
+        stats["types"].update(delta["types"])
+        
+        countries = stats["countries"]
+        for name, changed in delta["countries"].items():
+            if name == "TOTAL":
+                countries["TOTAL"] = changed
+                continue
+            
+            country = countries.setdefault(name, dict())
+            for key, value in changed.items():
+                if key == "TOTAL":
+                    country["TOTAL"] = value
+                else:
+                    country.setdefault(key, dict()).update(value)
+        
+        stats["top_incoming"] = delta["top_incoming"]
+        stats["top_outgoing"] = delta["top_outgoing"]
+        if "windows" in delta:
+            stats["windows"] = delta["windows"]
+    
+    def latest_stats(self) -> Optional[bytes]:
+        """ Frame of the latest statistics, what a client needs before it can apply deltas """
+        if self.stats_frame is None and self.stats is not None:
+            self.stats_frame = b"\nevent: stats\ndata: " + dumps(self.stats) + b"\n\n"
+        return self.stats_frame
+    
+    def flush_batch(self):
+        """ Sends the attacks collected in the current window as a single chunk """
+        if self.batch_timeout is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.batch_timeout)
+            self.batch_timeout = None
+        
+        if not self.batch:
+            return
+        
+        batch = self.batch
+        self.batch = list()
+        self.fan_out(self.batch_chunk(batch), kind = "batch", entries = batch)
+    
+    def batch_chunk(self, batch: List[Tuple[str, bytes, bytes]]) -> bytes:
+        """ Chunk of the attacks of a batch, as (id, message, frame) """
+        if self.batch_event:
+            last_id = batch[-1][0]
+            return b"\nevent: batch\ndata: [" + b",".join(msg for _, msg, _ in batch) + b"]\nid: " + \
+                   last_id.encode() + b"\n\n"
+        return b"".join(sse for _, _, sse in batch)
+    
+    def fan_out(self, sse: bytes, kind: str, entries: Optional[List[Tuple[str, bytes, bytes]]] = None):
+        """
+        Pushes a frame to every client. entries are the attacks of the frame as (id, message, frame), a client that
+        got some of them with its replay gets a frame of the others only.
+        """
+        for client in list(self.clients.values()):
+            if entries and client.replayed_until is not None:
+                unseen = [entry for entry in entries if not client.replayed(entry[0])]
+                if len(unseen) < len(entries):
+                    if unseen:
+                        client.send_message(self.batch_chunk(unseen), kind = kind)
+                    continue
+            client.send_message(sse, kind = kind)
+    
+    def event_id(self, msg: bytes) -> str:
+        """ Id the proxy assigned to an attack, or a local one if the producer did not assign any """
+        match = EVENT_ID_PATTERN.match(msg)
+        if match:
+            return match.group(1).decode("utf-8")
+        
+        try:
+            data = loads(msg)
+            if isinstance(data, dict) and data.get("id"):
+                return str(data["id"])
+        except ValueError:
+            pass
+        
+        return f"{self.epoch}-{next(self.event_counter)}"
+    
+    async def replay(self, event_id: str) -> Tuple[Optional[bytes], Optional[str]]:
+        """
+        Frames published after event_id joined in one chunk, None if event_id is not cached anymore, and the id of
+        the last entry read from the stream, which the listener may not have dispatched yet.
+        Returns to the caller without yielding to the loop after reading the cache, so a client registered right
+        after the replay neither misses nor duplicates a frame.
+        """
+        fetched = list()
+        if event_id not in self.cache and self.transport == "streams" and STREAM_ID_PATTERN.match(event_id):
+            try:
+                entries = await self.redis_pool.xrange(CHANNEL, start = event_id, stop = "+", count = self.replay_limit)
+            except aioredis.errors.RedisError:
+                logger.exception(f"Could not read the {CHANNEL} stream from {event_id}")
+                entries = list()
+            
+            for entry_id, fields in entries:
+                entry_id = entry_id.decode("utf-8")
+                if entry_id != event_id and b"data" in fields:
+                    fetched.append((entry_id, self.format_attack(entry_id, fields[b"data"])))
+            
+            if fetched:
+                event_id = fetched[-1][0]
+        
+        # attacks still waiting in a batch are in the cache already, they must not reach the client twice
+        self.flush_batch()
+        missed = self.cache.since(event_id)
+        if missed is None:
+            if not fetched:
+                return None, None
+            missed = list()
+        
+        return b"".join([frame for _, frame in fetched] + missed), fetched[-1][0] if fetched else None
+    
+    async def report_connections(self):
+        """ Publishes the number of clients of this process, every process of every host in one hash """
+        if not self.redis_pool:
+            return
+        try:
+            await self.redis_pool.hset(CONNECTIONS_KEY, self.process_name, dumps([len(self.clients), time.time()]))
+        except (aioredis.errors.RedisError, OSError):
+            logger.exception("Could not report the connections of this process")
+    
+    async def connections(self, stale_after: float = 10.0) -> Dict[str, int]:
+        """ Clients of every SSE server process, leaving out the processes that stopped reporting """
+        if not self.redis_pool:
+            return {self.process_name: len(self.clients)}
+        
+        now = time.time()
+        counts = dict()
+        for name, value in (await self.redis_pool.hgetall(CONNECTIONS_KEY)).items():
+            clients, reported = loads(value)
+            if now - reported <= stale_after:
+                counts[name.decode("utf-8")] = clients
+        return counts
+    
+    def register(self, client: "SSEHandler"):
+        self.clients[client.con_id] = client
+    
+    def unregister(self, client: "SSEHandler"):
+        self.clients.pop(client.con_id, None)
+    
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = list()
+        
+        # a redis-server that is down already must not turn a clean shutdown into a traceback
+        errors = (aioredis.errors.RedisError, OSError, asyncio.TimeoutError)
+        if self.stream_reader:
+            self.stream_reader.close()
+            try:
+                await self.stream_reader.wait_closed()
+            except errors as error:
+                logger.warning(f"Could not close the {CHANNEL} stream reader: {error!r}")
+            self.stream_reader = None
+        
+        if self.redis_pool:
+            try:
+                await self.redis_pool.hdel(CONNECTIONS_KEY, self.process_name)
+                await self.redis_pool.unsubscribe(*self.channels_names)
+                logger.info("redis pool unsubscribe success")
+            except errors as error:
+                logger.warning(f"Could not unsubscribe from redis on shutdown: {error!r}")
+            if self.receiver:
+                self.receiver.stop()
+            try:
+                await RedisWatcher.close_async_pool(self.address)
+            except errors as error:
+                logger.warning(f"Could not close the redis pool: {error!r}")
+            self.redis_pool = None
+
 
 class SSEHandler(tornado.web.RequestHandler):
     # class items
-    cache = list()
-    cache_limit = 200
-    redis_pool: aioredis.Redis = None
-    online_clients: Dict[str, Any] = dict()
+    broadcaster: Broadcaster = Broadcaster()
+    # position of the last attack the replay read from the stream, the listener may dispatch it afterwards
+    replayed_until: Optional[Tuple[int, int]] = None
+    queue_limit: int = 256
+    queue_policy: str = "drop-oldest"
+    backpressure_timeout: float = 10.0
     
-    
-    def initialize(self):
+    def initialize(
+            self,
+            queue_limit: Optional[int] = None,
+            queue_policy: Optional[str] = None,
+            backpressure_timeout: Optional[float] = None
+    ):
         self.con_id: str = hashlib.md5(f"{self.request.remote_ip}-{time.time()}".encode()).hexdigest()
-        self.channels_names = ['cyberattacks', 'cyberstats']
-        self.aioredis_channels: List[aioredis.Channel] = list()
+        self.channels_names = self.broadcaster.channels_names
+        self.closed = tornado.locks.Event()
+        
+        if queue_limit is not None:
+            self.queue_limit = queue_limit
+        if queue_policy is not None:
+            self.queue_policy = queue_policy
+        if backpressure_timeout is not None:
+            self.backpressure_timeout = backpressure_timeout
+        if self.queue_policy not in QUEUE_POLICIES:
+            raise ValueError(f"Queue policy {self.queue_policy} is not defined. Use one of [{','.join(QUEUE_POLICIES)}]")
+        
+        # frames waiting to be written, as (kind, frame) tuples
+        self.queue: Deque[Tuple[str, bytes]] = deque()
+        self.queue_event = tornado.locks.Event()
+        self.max_depth: int = 0
+        self.dropped: int = 0
+        # a statistics frame was dropped, the client needs a snapshot before the next delta
+        self.stats_stale: bool = False
+        self.writes: int = 0
+        self.flush_pending_since: Optional[float] = None
+        
         self.set_sse_headers()
     
     def set_sse_headers(self):
@@ -53,90 +462,163 @@ class SSEHandler(tornado.web.RequestHandler):
             await self.finish()
         else:
             await self.on_open(*args, **kwargs)
+            # keep the request open, writing the frames pushed by the broadcaster until the client goes away
+            await self.drain()
     
     async def on_open(self, *args, **kwargs):
         """ Invoked for a new connection opened. """
         logger.info(
             f"New /events incoming connection with id {self.con_id} for channels [{', '.join(self.channels_names)}]")
         
-        self.online_clients[self.con_id] = self
-        
-        if not self.redis_pool:
-            try:
-                # This is the IP address of the Proxy
-                self.redis_pool = await aioredis.create_redis_pool(address = ("127.0.0.1", 6379))
-            except Exception:
-                logger.exception("Could not connect to Redis server.")
-                raise
+        await self.broadcaster.start()
         
+        # the replay reads the cache right before registration without yielding, so no frame is lost or sent twice
+        missed = None
         event_id = self.request.headers.get('Last-Event-ID', None)
         if event_id:
-            pass
+            missed, replayed_id = await self.broadcaster.replay(event_id)
+            if missed is None:
+                logger.info(f"[CLIENT {self.con_id}] last event {event_id} is not cached anymore")
+            if replayed_id is not None:
+                self.replayed_until = stream_position(replayed_id)
         
-        await self.subscribe()
-    
-    async def subscribe(self):
-        self.receiver = aioredis.pubsub.Receiver()
-        for channel in self.channels_names:
-            ch: aioredis.Channel = self.receiver.channel(name = channel)
-            await self.redis_pool.subscribe(ch)
-            self.aioredis_channels.append(ch)
+        # the latest statistics first, the deltas that follow apply to them
+        stats = self.broadcaster.latest_stats()
+        if stats:
+            self.send_message(stats, kind = "stats")
+        if missed:
+            self.send_message(missed, kind = "replay")
         
+        self.broadcaster.register(self)
         logger.info(
             f"[CLIENT {self.con_id}] is listening for messages in channels [{','.join(self.channels_names)}]")
-        async for channel, msg in self.receiver.iter():
-            assert isinstance(channel, aioredis.pubsub.AbcChannel)
-            sse = None
-            msg_id = str(uuid.uuid4())
-            decoded = msg.decode("utf-8")
-            channel_name = channel.name.decode("utf-8")
-            if channel_name == "cyberattacks":
-                sse = f"\n" \
-                      f"event: message\n" \
-                      f"data: {decoded}\n" \
-                      f"id: {msg_id}\n" \
-                      f"\n"
-                
-                if len(self.cache) > self.cache_limit:
-                    self.cache = self.cache[-self.cache_limit:]
-                
-                self.cache.append({
-                    'id': msg_id,
-                    'channel': channel,
-                    'body': sse,
-                })
-            elif channel_name == "cyberstats":
-                sse = f"\n" \
-                      f"event: stats\n" \
-                      f"data: {decoded}\n" \
-                      f"id: {msg_id}\n" \
-                      f"\n"
-            if sse:
-                self.send_message(sse)
-    
-    async def unsubscribe(self):
-        for ch in self.aioredis_channels:
-            await self.redis_pool.unsubscribe(ch)
-        self.redis_pool.close()
-        logger.info("redis pool unsubscribe success")
-    
-    def send_message(self, message):
-        self.write(message)
-        self.flush()
+    
+    async def drain(self):
+        """ Writes the queued frames, waiting for each flush so a slow client cannot grow tornado's buffer """
+        while not self.closed.is_set():
+            if not self.queue:
+                self.queue_event.clear()
+                await self.queue_event.wait()
+                continue
+            
+            frames = b"".join(frame for _, frame in self.queue)
+            self.queue.clear()
+            self.write(frames)
+            self.writes += 1
+            self.flush_pending_since = time.monotonic()
+            try:
+                await self.flush()
+            except tornado.iostream.StreamClosedError:
+                break
+            finally:
+                self.flush_pending_since = None
+    
+    def send_message(self, message: bytes, kind: str = "message"):
+        """ Queues a frame for this client applying the queue policy when the client can not keep up """
+        if self.closed.is_set():
+            return
+        
+        if self.queue_policy == "disconnect" and self.backpressure > self.backpressure_timeout:
+            logger.warning(f"[CLIENT {self.con_id}] disconnected after {self.backpressure:.2f} seconds of backpressure")
+            self.request.connection.close()
+            return
+        
+        if self.queue_policy == "coalesce" and kind == "stats":
+            # only the latest statistics are worth delivering to a client that is behind, deltas included
+            for item in [item for item in self.queue if item[0] in ("stats", "stats-delta")]:
+                self.queue.remove(item)
+                self.dropped += 1
+        
+        if len(self.queue) >= self.queue_limit:
+            evicted, _ = self.queue.popleft()
+            self.dropped += 1
+            if evicted in ("stats", "stats-delta"):
+                # the statistics frames left would apply to a missing base, the next delta goes out as a snapshot
+                for item in [item for item in self.queue if item[0] in ("stats", "stats-delta")]:
+                    self.queue.remove(item)
+                    self.dropped += 1
+                self.stats_stale = True
+        
+        if kind == "stats-delta" and self.stats_stale:
+            snapshot = self.broadcaster.latest_stats()
+            if snapshot is not None:
+                message, kind = snapshot, "stats"
+        if kind == "stats":
+            self.stats_stale = False
+        
+        self.queue.append((kind, message))
+        self.max_depth = max(self.max_depth, len(self.queue))
+        self.queue_event.set()
+    
+    def replayed(self, msg_id: str) -> bool:
+        """ Whether the replay sent the attack already, the first later attack ends the checks """
+        if self.replayed_until is None or not STREAM_ID_PATTERN.match(msg_id):
+            return False
+        if stream_position(msg_id) <= self.replayed_until:
+            return True
+        self.replayed_until = None
+        return False
+    
+    @property
+    def backpressure(self) -> float:
+        """ Seconds the current flush has been waiting for the client """
+        if self.flush_pending_since is None:
+            return 0.0
+        return time.monotonic() - self.flush_pending_since
+    
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "depth": len(self.queue),
+            "limit": self.queue_limit,
+            "policy": self.queue_policy,
+            "max_depth": self.max_depth,
+            "dropped": self.dropped,
+            "writes": self.writes,
+            "backpressure": round(self.backpressure, 3),
+        }
+    
+    @classmethod
+    def queue_metrics(cls) -> Dict[str, Any]:
+        """ Queue depth of every live connection, so memory under burst load can be capped """
+        clients = {con_id: client.metrics() for con_id, client in cls.broadcaster.clients.items()}
+        return {
+            "clients": len(clients),
+            "total_depth": sum(metrics["depth"] for metrics in clients.values()),
+            "total_dropped": sum(metrics["dropped"] for metrics in clients.values()),
+            "total_writes": sum(metrics["writes"] for metrics in clients.values()),
+            "per_client": clients,
+        }
     
     @classmethod
-    def send_to_all(cls):
+    def send_to_all(cls, message):
         """ Sends a message to all live connections """
-        for connection in cls.online_clients.values():
-            connection.send_message()
+        for connection in list(cls.broadcaster.clients.values()):
+            connection.send_message(message)
     
     def on_connection_close(self):
         """ Closes the connection for this instance """
         logger.info('Connection %s is closed' % self.con_id)
         
-        del self.online_clients[self.con_id]
-        
-        tornado.ioloop.IOLoop.current().add_callback(self.unsubscribe)
-        
+        self.broadcaster.unregister(self)
+        self.closed.set()
+        self.queue.clear()
+        self.queue_event.set()
         
         self.request.connection.finish()
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """ Reports the send queues of the /events connections of this process and the clients of every process """
+    
+    async def get(self):
+        metrics = SSEHandler.queue_metrics()
+        metrics["process"] = SSEHandler.broadcaster.process_name
+        try:
+            metrics["connections"] = await SSEHandler.broadcaster.connections()
+        except aioredis.errors.RedisError:
+            metrics["connections"] = {metrics["process"]: metrics["clients"]}
+        metrics["total_clients"] = sum(metrics["connections"].values())
+        
+        self.set_header("Content-Type", "application/json")
+        self.set_header("Cache-Control", "no-cache")
+        self.write(dumps(metrics))
@@ -8,6 +8,8 @@ import time
 import datetime
 import redis
 import click
+import asyncio
+import aioredis
 from click_help_colors import HelpColorsCommand
 import timeit
 import pickle
@@ -19,26 +21,55 @@ import maxminddb
 import cryptography.fernet
 import threading
 import shutil
+import socket
+import signal
+import heapq
+import itertools
+import multiprocessing
+import queue
 
+from array import array
 from itertools import islice
 from datetime import timedelta
+from collections import deque
+from contextlib import contextmanager
 
 # import keyring
 from options import Options
 from pprint import pprint
 from copy import copy, deepcopy
-from typing import Optional, List, Dict, Any, Set, Union
+from typing import Optional, List, Dict, Any, Set, Union, Deque, Callable, Tuple, Iterator
 from textwrap import dedent
 
 from cyberserver.servers import utilities
 from cyberserver.servers.utilities import RedisWatcher
 from cyberserver.servers import AttacksGenerator
+from cyberserver.servers.geolocation import (
+    GeoCache,
+    PrefixIndex,
+    FragmentCache,
+    DATABASE_MODES,
+    open_reader,
+    clean_ip,
+    located,
+)
+from cyberserver.servers.stats_store import (
+    STATS_STORES,
+    STATS_FORMATS,
+    WINDOWS,
+    RollingWindow,
+    FileStatsStore,
+    RedisStatsStore,
+)
 
 
 _script_path = pathlib.Path(__file__)
 _script_stem = _script_path.stem
 _script_name = _script_path.name
 
+# what is published on the stats channel: full statistics on every tick or periodic snapshots and deltas
+STATS_MODES = ["full", "delta"]
+
 
 def erase_line():
     sys.stdout.write("\033[1000D\033[K")
@@ -46,78 +77,339 @@ def erase_line():
 
 
 class ServerStats(object):
+    """
+    Attack counters per protocol and per country and direction.
+    
+    The ingest loop only records attacks in a queue, which never blocks. The counters have a single writer, the
+    thread reading them: reading() applies the recorded attacks under a lock and keeps the counters still until
+    the reader is done, so snapshots are consistent and never iterate counters that are being updated.
+    
+    Protocols and countries are interned to ints and counted in arrays indexed by those ints. Countries are ranked
+    by RankedCounters, which stay sorted as they are incremented, so recording an attack costs O(1) and a snapshot
+    reads the top countries in order instead of sorting every country. The per protocol counters are few and only
+    ordered when they are published.
+    """
+    
+    # the types binary attack records can carry
+    PROTOCOLS = utilities.ATTACK_TYPES
+    DIRECTIONS = ["incoming", "outgoing"]
+    # counted for the records located on the map without a country, e.g. anonymous proxies, the counters are keyed
+    # by strings once serialized
+    UNKNOWN_COUNTRY = "Unknown"
     
     def __init__(self):
-        self.types = {
-            "TOTAL": 0,
-            "AUTH": 0,
-            "DNS": 0,
-            "DoS": 0,
-            "EMAIL": 0,
-            "FTP": 0,
-            "HTTP": 0,
-            "HTTPS": 0,
-            "ICMP": 0,
-            "RDP": 0,
-            "SFTP": 0,
-            "SMB": 0,
-            "SNMP": 0,
-            "SQL": 0,
-            "SSH": 0,
-            "TELNET": 0,
-            "WHOIS": 0,
-        }
+        self.reset()
         self.ips = {
             "TOTAL": 0
         }
-        self.countries: Dict[str, Union[Dict, int]] = {
-            "TOTAL": 0,
+    
+    def reset(self):
+        # attacks recorded by the ingest loop and not counted yet, as (protocol, source country, destination country)
+        self.pending: Deque[Tuple[str, str, str]] = deque()
+        self.lock = threading.RLock()
+        
+        self.protocol_ids: Dict[str, int] = dict()
+        self.protocol_names: List[str] = list()
+        self.country_ids: Dict[str, int] = dict()
+        self.country_names: List[str] = list()
+        
+        # attacks per protocol id
+        self.protocols = array('Q')
+        self.total: int = 0
+        # attacks per country id, both directions
+        self.country_totals = utilities.RankedCounter()
+        # attacks per country id, for each direction
+        self.direction_totals: Dict[str, utilities.RankedCounter] = {
+            direction: utilities.RankedCounter() for direction in self.DIRECTIONS
+        }
+        # attacks per protocol id, for each direction and country id, None until the country is seen in that direction
+        self.direction_protocols: Dict[str, List[Optional[array]]] = {
+            direction: list() for direction in self.DIRECTIONS
         }
         
-        file = pathlib.Path("/var/log/cybermap/cybermap_stats.json")
-        if file.exists():
-            os.remove(file)
+        for protocol in self.PROTOCOLS:
+            self.protocol_id(protocol)
+    
+    def protocol_id(self, protocol: str) -> int:
+        protocol_id = self.protocol_ids.get(protocol)
+        if protocol_id is None:
+            protocol_id = self.protocol_ids[protocol] = len(self.protocol_names)
+            self.protocol_names.append(protocol)
+            self.protocols.append(0)
+        return protocol_id
+    
+    def country_id(self, country: str) -> int:
+        country_id = self.country_ids.get(country)
+        if country_id is None:
+            country_id = self.country_ids[country] = len(self.country_names)
+            self.country_names.append(country)
+            for direction in self.DIRECTIONS:
+                self.direction_protocols[direction].append(None)
+        return country_id
+    
+    def record(self, type_of_attack: str, source: str, destination: str):
+        """ Records an attack from the ingest loop, it is counted by the next reader """
+        self.pending.append((type_of_attack, source or self.UNKNOWN_COUNTRY, destination or self.UNKNOWN_COUNTRY))
+    
+    def flush(self):
+        """ Counts the recorded attacks, with the lock held """
+        pending = self.pending
+        for _ in range(len(pending)):
+            type_of_attack, source, destination = pending.popleft()
+            self.update_type(type_of_attack)
+            self.update_country(source, type_of_attack, "incoming")
+            self.update_country(destination, type_of_attack, "outgoing")
+    
+    @contextmanager
+    def reading(self) -> Iterator["ServerStats"]:
+        """ Counters including every attack recorded so far, unchanged until the block ends """
+        with self.lock:
+            self.flush()
+            yield self
     
     def update_type(self, type_of_attack: str, where: str = "types"):
-        if hasattr(self, where):
+        if where == "types":
+            self.protocols[self.protocol_id(type_of_attack)] += 1
+            self.total += 1
+        elif hasattr(self, where):
             self.__dict__[where]["TOTAL"] += 1
-            if type_of_attack not in self.__dict__[where].keys():
-                self.__dict__[where][type_of_attack] = 1
-            else:
-                self.__dict__[where][type_of_attack] += 1
+            self.__dict__[where][type_of_attack] = self.__dict__[where].get(type_of_attack, 0) + 1
     
     def update_country(self, country, type_of_attack, direction = "incoming"):
-        self.countries["TOTAL"] += 1
-        if country in self.countries:
-            self.countries[country]["TOTAL"] += 1
-            if direction in self.countries[country].keys():
-                self.countries[country][direction]["TOTAL"] += 1
-                if type_of_attack not in self.countries[country][direction].keys():
-                    self.countries[country][direction][type_of_attack] = 1
-                else:
-                    self.countries[country][direction][type_of_attack] += 1
-            else:
-                self.countries[country][direction] = dict()
-                self.countries[country][direction]["TOTAL"] = 1
-                self.countries[country][direction][type_of_attack] = 1
-        else:
-            self.countries[country] = {"TOTAL": 1}
-            self.countries[country][direction] = {type_of_attack: 1, "TOTAL": 1}
+        country_id = self.country_id(country)
+        protocol_id = self.protocol_id(type_of_attack)
+        self.country_totals.increment(country_id)
+        self.direction_totals[direction].increment(country_id)
+        
+        protocols = self.direction_protocols[direction][country_id]
+        if protocols is None:
+            protocols = self.direction_protocols[direction][country_id] = array('Q')
+        if protocol_id >= len(protocols):
+            protocols.extend([0] * (protocol_id + 1 - len(protocols)))
+        protocols[protocol_id] += 1
+    
+    @property
+    def types(self) -> Dict[str, int]:
+        """ Attacks per protocol, with their TOTAL """
+        types = {"TOTAL": self.total}
+        for protocol_id, protocol in enumerate(self.protocol_names):
+            types[protocol] = self.protocols[protocol_id]
+        return types
+    
+    @property
+    def countries(self) -> Dict[str, Union[Dict, int]]:
+        """ Attacks per country and direction with their TOTAL, the countries with the most attacks first """
+        countries: Dict[str, Union[Dict, int]] = {"TOTAL": self.country_totals.total}
+        for country_id, count in self.country_totals.ranked():
+            country = {"TOTAL": count}
+            for direction in self.DIRECTIONS:
+                if self.direction_protocols[direction][country_id] is not None:
+                    country[direction] = self.breakdown(direction, country_id)
+            countries[self.country_names[country_id]] = country
+        return countries
+    
+    def breakdown(self, direction: str, country_id: int) -> Dict[str, int]:
+        """ Attacks per protocol of a country in direction with their TOTAL, the most frequent protocols first """
+        protocols = self.direction_protocols[direction][country_id]
+        breakdown = {"TOTAL": self.direction_totals[direction][country_id]}
+        for protocol_id in sorted(range(len(protocols)), key = protocols.__getitem__, reverse = True):
+            if not protocols[protocol_id]:
+                break
+            breakdown[self.protocol_names[protocol_id]] = protocols[protocol_id]
+        return breakdown
+    
+    def top(self, direction: str, k: int = 5) -> Dict[str, Dict[str, int]]:
+        """ Protocols of the k countries with the most attacks in direction """
+        return {
+            self.country_names[country_id]: self.breakdown(direction, country_id)
+            for country_id, count in self.direction_totals[direction].top(k)
+        }
+    
+    def totals(self) -> Dict[str, Dict[str, int]]:
+        """ Attacks per protocol and per country in each direction, what the rolling windows are computed from """
+        totals = {
+            "types": {protocol: self.protocols[protocol_id] for protocol_id, protocol in enumerate(self.protocol_names)}
+        }
+        for direction in self.DIRECTIONS:
+            counter = self.direction_totals[direction]
+            totals[direction] = {self.country_names[country_id]: count for country_id, count in counter.ranked()}
+        return totals
+    
+    def snapshot(self, k: int = 5) -> Dict[str, Dict]:
+        """ The statistics published on the stats channel """
+        types = {"TOTAL": self.total}
+        for protocol_id in sorted(range(len(self.protocols)), key = self.protocols.__getitem__, reverse = True):
+            types[self.protocol_names[protocol_id]] = self.protocols[protocol_id]
+        
+        return {
+            "types": types,
+            "countries": self.countries,
+            "top_incoming": self.top("incoming", k),
+            "top_outgoing": self.top("outgoing", k),
+        }
+    
+    @classmethod
+    def from_counters(cls, types: Dict[str, int], countries: Dict[str, Union[Dict, int]]) -> "ServerStats":
+        """ ServerStats with the counters of types and countries dicts, e.g. the combined statistics of workers """
+        stats = cls.__new__(cls)
+        stats.reset()
+        stats.ips = {"TOTAL": 0}
+        
+        for protocol, count in types.items():
+            if protocol != "TOTAL":
+                stats.protocols[stats.protocol_id(protocol)] = count
+        stats.total = types.get("TOTAL", 0)
+        
+        for country in countries:
+            if country != "TOTAL":
+                stats.country_id(country)
+        stats.country_totals.load([countries[country]["TOTAL"] for country in stats.country_names])
+        
+        for direction in cls.DIRECTIONS:
+            totals = list()
+            for country_id, country in enumerate(stats.country_names):
+                breakdown = countries[country].get(direction)
+                totals.append(breakdown["TOTAL"] if breakdown else 0)
+                if breakdown is None:
+                    continue
+                
+                protocols = stats.direction_protocols[direction][country_id] = array('Q')
+                for protocol, count in breakdown.items():
+                    if protocol == "TOTAL":
+                        continue
+                    protocol_id = stats.protocol_id(protocol)
+                    if protocol_id >= len(protocols):
+                        protocols.extend([0] * (protocol_id + 1 - len(protocols)))
+                    protocols[protocol_id] = count
+            stats.direction_totals[direction].load(totals)
+        
+        return stats
+    
+    @staticmethod
+    def combine(snapshots: List[Dict[str, Dict]]) -> Dict[str, Dict]:
+        """
+        Sums the counters of several ServerStats
+        
+        :param snapshots: dicts with the types and countries of each ServerStats
+        :return: a dict with the summed types and countries
+        """
+        types: Dict[str, int] = dict()
+        countries: Dict[str, Union[Dict, int]] = {"TOTAL": 0}
+        
+        for snapshot in snapshots:
+            for type_of_attack, count in snapshot["types"].items():
+                types[type_of_attack] = types.get(type_of_attack, 0) + count
+            
+            for country, obj in snapshot["countries"].items():
+                if country == "TOTAL":
+                    countries["TOTAL"] += obj
+                    continue
+                
+                combined = countries.setdefault(country, {"TOTAL": 0})
+                for key, value in obj.items():
+                    if key == "TOTAL":
+                        combined["TOTAL"] += value
+                        continue
+                    
+                    direction = combined.setdefault(key, dict())
+                    for type_of_attack, count in value.items():
+                        direction[type_of_attack] = direction.get(type_of_attack, 0) + count
+        
+        return {"types": types, "countries": countries}
     
-    def export_stats(self, file: Optional[Union[pathlib.Path, str]] = "cybermap_stats.json", mode: str = "a"):
+    def export_stats(self, file: Optional[Union[pathlib.Path, str]] = "cybermap_stats.json", fmt: str = "json"):
+        """
+        Writes the statistics to a temporary file that replaces file once complete, so readers never see a
+        partial document
+        
+        :param file: a .json file, relative paths are in /var/log/cybermap
+        :param fmt: one of STATS_FORMATS
+        """
         if pathlib.Path(file).suffix != ".json":
             raise ValueError
         
         if pathlib.Path(file).is_dir():
             raise ValueError("file argument must be file not a directory")
         
-        folder = pathlib.Path("/var/log/cybermap")
-        if not folder.exists():
-            folder.mkdir()
+        with self.reading():
+            state = {"types": self.types, "countries": self.countries}
+        FileStatsStore(pathlib.Path("/var/log/cybermap") / file, fmt = fmt).save(state)
+
+
+class StatsEncoder(object):
+    """
+    Encodes the statistics of the stats channel as a full snapshot every few ticks and, in between, deltas with
+    the counters that changed since the previous tick. Messages are numbered, so a subscriber knows that it
+    missed a delta and has to wait for the next snapshot.
+    
+    Counters only grow, so a country whose TOTAL did not change has no changed counter and a delta costs
+    O(countries) comparisons plus the breakdowns of the countries that changed.
+    """
+    
+    def __init__(self, snapshot_every: int = 20, k: int = 5):
+        """
+        :param snapshot_every: ticks between two full snapshots
+        :param k: countries of the top incoming and outgoing
+        """
+        if snapshot_every < 1:
+            raise ValueError("snapshot_every must be a positive integer")
+        
+        self.snapshot_every: int = snapshot_every
+        self.k: int = k
+        self.seq: int = 0
+        # counters sent so far, by name
+        self.types: Dict[str, int] = dict()
+        self.countries: Dict[str, Union[Dict, int]] = dict()
+    
+    def encode(self, stats: ServerStats) -> Dict[str, Any]:
+        self.seq += 1
+        # a smaller total means the counters were reset
+        if (self.seq - 1) % self.snapshot_every == 0 or stats.total < self.types.get("TOTAL", 0):
+            return self.snapshot(stats)
+        return self.delta(stats)
+    
+    def snapshot(self, stats: ServerStats) -> Dict[str, Any]:
+        snapshot = stats.snapshot(self.k)
+        self.types = snapshot["types"]
+        self.countries = snapshot["countries"]
+        return {"seq": self.seq, "kind": "snapshot", **snapshot}
+    
+    def delta(self, stats: ServerStats) -> Dict[str, Any]:
+        types = {protocol: count for protocol, count in stats.types.items() if self.types.get(protocol) != count}
+        self.types.update(types)
+        
+        countries: Dict[str, Union[Dict, int]] = dict()
+        if self.countries.get("TOTAL") != stats.country_totals.total:
+            countries["TOTAL"] = self.countries["TOTAL"] = stats.country_totals.total
+        
+        for country_id, count in stats.country_totals.ranked():
+            name = stats.country_names[country_id]
+            previous = self.countries.get(name)
+            if previous is not None and previous["TOTAL"] == count:
+                continue
+            
+            previous = self.countries.setdefault(name, dict())
+            changed = {"TOTAL": count}
+            previous["TOTAL"] = count
+            for direction in stats.DIRECTIONS:
+                if stats.direction_protocols[direction][country_id] is None:
+                    continue
+                breakdown = stats.breakdown(direction, country_id)
+                sent = previous.setdefault(direction, dict())
+                updated = {protocol: count for protocol, count in breakdown.items() if sent.get(protocol) != count}
+                if updated:
+                    changed[direction] = updated
+                    sent.update(updated)
+            countries[name] = changed
         
-        full_path: pathlib.Path = folder / file
-        with full_path.open(mode = mode, encoding = 'utf-8') as f:
-            json.dump(self.types, f, ensure_ascii = False, indent = 4, sort_keys = True)
+        return {
+            "seq": self.seq,
+            "kind": "delta",
+            "types": types,
+            "countries": countries,
+            "top_incoming": stats.top("incoming", self.k),
+            "top_outgoing": stats.top("outgoing", self.k),
+        }
 
 
 class Proxy(object):
@@ -127,25 +419,85 @@ class Proxy(object):
             self,
             redis_ip: Optional[str] = "127.0.0.1",
             redis_port: Optional[int] = 6379,
+            redis_socket: Optional[str] = None,
+            redis_pool_size: int = 64,
+            redis_health_check: float = 30,
             database: Optional[Union[str, pathlib.Path]] = None,
+            database_mode: str = "mmap",
+            database_reload_interval: float = 0,
             verbose: bool = False,
-            silent: bool = False
+            silent: bool = False,
+            transport: str = "pubsub",
+            stream_batch: int = 100,
+            stream_maxlen: int = 10000,
+            publish_batch_size: int = 64,
+            publish_deadline: float = 0.01,
+            stats_mode: str = "full",
+            stats_snapshot_every: int = 20,
+            stats_file: Optional[Union[str, pathlib.Path]] = "cybermap_stats.json",
+            stats_interval: float = 10.0,
+            stats_format: str = "json",
+            stats_store: str = "file",
+            stats_key: str = "cybermap:stats",
+            geo_cache_size: int = 65536,
+            geo_cache_ttl: float = 0,
+            geo_index: bool = False,
+            geo_index_path: Optional[Union[str, pathlib.Path]] = None,
+            codec: Optional[str] = None
     ):
+        if transport not in utilities.TRANSPORTS:
+            raise ValueError(f"transport {transport} is not available. Available: {','.join(utilities.TRANSPORTS)}")
+        if stats_mode not in STATS_MODES:
+            raise ValueError(f"stats mode {stats_mode} is not available. Available: {','.join(STATS_MODES)}")
+        if stats_format not in STATS_FORMATS:
+            raise ValueError(f"stats format {stats_format} is not available. Available: {','.join(STATS_FORMATS)}")
+        if stats_store not in STATS_STORES:
+            raise ValueError(f"stats store {stats_store} is not available. Available: {','.join(STATS_STORES)}")
+        
+        # the codec is process-wide, workers get it through their options
+        utilities.use_codec(codec)
+        
         self.options = Options(**{
             "platform": utilities.get_platform(),
+            "codec": codec,
             "path_geolite_db": database,
+            "geolite_db_mode": database_mode,
+            "reload_interval": database_reload_interval,
             "redis_ip": redis_ip,
             "redis_port": redis_port,
+            "redis_socket": redis_socket,
+            "redis_pool_size": redis_pool_size,
+            "redis_health_check": redis_health_check,
             "receive_channel": "raw-cyberattacks",
             "forward_channel": "cyberattacks",
             "stats_channel": "cyberstats",
+            "transport": transport,
+            "stream_batch": stream_batch,
+            "stream_maxlen": stream_maxlen,
+            "publish_batch_size": publish_batch_size,
+            "publish_deadline": publish_deadline,
+            "publisher": None,
+            "stats_mode": stats_mode,
+            "stats_snapshot_every": stats_snapshot_every,
+            "stats_file": stats_file,
+            "stats_interval": stats_interval,
+            "stats_format": stats_format,
+            "stats_store": stats_store,
+            "stats_key": stats_key,
             "verbose": verbose,
             "silent": silent,
             "stats": None,
             "geolite_db": None,
+            "geo_cache": None,
+            "geo_cache_size": geo_cache_size,
+            "geo_cache_ttl": geo_cache_ttl,
+            "geo_index": None,
+            "use_geo_index": geo_index,
+            "geo_index_path": geo_index_path,
             "redis_watcher": None,
             "redis_pubsub": None,
             "start_time": None,
+            "epoch": None,
             "end_time": None,
             "total_time": None
         })
@@ -167,81 +519,168 @@ class Proxy(object):
             self._logger.warning(
                 f"Running proxy server as {utilities.colorize('root', color = 'gold_1')} is suggested.")
         
+        # statistics persistence, set up by start
+        self.store: Optional[Union[FileStatsStore, RedisStatsStore]] = None
+        self.restored: Optional[Dict[str, Dict]] = None
+        self.windows: Dict[str, RollingWindow] = dict()
+        
+        # readers replaced by a reload, closed by the ingest loop once no lookup can still be using them
+        self._retired_databases: List[maxminddb.reader.Reader] = list()
+        self._reload_lock = threading.Lock()
         self.connect_to_database()
         
+        # serialized parts of the published messages, see forge
+        self.fragments = FragmentCache(size = self.geo_cache_size or 65536)
+        self.protocol_fragments: Dict[str, bytes] = dict()
+        self.event_second: int = 0
+        self.event_time_fragment: bytes = b'""'
+        
         try:
-            self.redis_watcher = RedisWatcher(ip = redis_ip, port = redis_port, silent = self.silent)
+            self.redis_watcher = RedisWatcher(
+                ip = redis_ip,
+                port = redis_port,
+                silent = self.silent,
+                unix_socket = redis_socket,
+                max_connections = redis_pool_size,
+                health_check_interval = redis_health_check
+            )
         except redis.exceptions.ExecAbortError:
             self._logger.exception(f"Proxy needs a redis-server to work properly. Aborting execution")
             raise
     
     def send_statistics(self):
+        encoder = StatsEncoder(snapshot_every = self.stats_snapshot_every) if self.stats_mode == "delta" else None
         while True:
-            attack_types = {k: v for k, v in
-                            sorted(self.stats.types.items(), key = lambda item: item[1], reverse = True)}
-            countries = dict()
-            
-            for country_name, obj in self.stats.countries.items():
-                if country_name == "TOTAL":
-                    countries[country_name] = obj
-                    continue
-                
-                if country_name not in countries.keys():
-                    countries[country_name] = dict()
-                
-                for key in obj.keys():
-                    if key == "TOTAL":
-                        country_types = obj[key]
-                    else:
-                        country_types = {k: v for k, v in
-                                         sorted(obj[key].items(), key = lambda item: item[1], reverse = True)}
-                    
-                    countries[country_name][key] = country_types
-            
-            def sorterer(key):
-                if key[0] == "TOTAL":
-                    return key[1]
-                return key[1]["TOTAL"]
-            
-            countries = {k: v for k, v in sorted(countries.items(), key = sorterer, reverse = True)}
-            
-            top_incoming = {k: v["incoming"] for k, v in countries.items() if k != "TOTAL" and "incoming" in v}
-            top_incoming = {k: v for k, v in sorted(top_incoming.items(), key = lambda item: item[1]["TOTAL"], reverse = True)}
-            top_incoming = {k: top_incoming[k] for k in list(top_incoming)[:5]}
-
-            top_outgoing = {k: v["outgoing"] for k, v in countries.items() if k != "TOTAL" and "outgoing" in v}
-            top_outgoing = {k: v for k, v in sorted(top_outgoing.items(), key = lambda item: item[1]["TOTAL"], reverse = True)}
-            top_outgoing = {k: top_outgoing[k] for k in list(top_outgoing)[:5]}
-            
-            data = {
-                "types": attack_types,
-                "countries": countries,
-                "top_incoming": top_incoming,
-                "top_outgoing": top_outgoing,
-            }
-            data = json.dumps(data)
-            self.redis_watcher.server.publish(self.stats_channel, data)
+            try:
+                with self.stats.reading() as stats:
+                    data = encoder.encode(stats) if encoder else stats.snapshot()
+                    data["windows"] = self.window_statistics(stats)
+                self.redis_watcher.server.publish(self.stats_channel, utilities.dumps(data))
+            except Exception:
+                # the next round publishes fresh statistics, the thread must outlive a failed one
+                self._logger.exception(f"Statistics could not be published to {self.stats_channel}")
             time.sleep(3)
     
-    def run(self, *args, **kwargs):
+    def window_statistics(self, stats: ServerStats, k: int = 5) -> Dict[str, Dict[str, Dict[str, int]]]:
+        """ Protocols and top countries of each rolling window, e.g. the top attackers of the last hour """
+        totals = stats.totals()
+        windows = dict()
+        for name, window in self.windows.items():
+            window.record(totals)
+            counts = window.counts(totals)
+            windows[name] = {
+                "types": dict(sorted(counts["types"].items(), key = lambda item: item[1], reverse = True)),
+                "top_incoming": dict(heapq.nlargest(k, counts["incoming"].items(), key = lambda item: item[1])),
+                "top_outgoing": dict(heapq.nlargest(k, counts["outgoing"].items(), key = lambda item: item[1])),
+            }
+        return windows
+    
+    def open_stats_store(self) -> Optional[Union[FileStatsStore, RedisStatsStore]]:
+        if self.stats_store == "redis":
+            return RedisStatsStore(self.redis_watcher.server, key = self.stats_key)
+        if self.stats_file:
+            return FileStatsStore(pathlib.Path("/var/log/cybermap") / self.stats_file, fmt = self.stats_format)
+        return None
+    
+    def restore_statistics(self) -> ServerStats:
+        """ Statistics and rolling windows saved by a previous run, empty ones if there are none """
+        self.windows = {name: RollingWindow(span, buckets) for name, (span, buckets) in WINDOWS.items()}
+        self.restored = None
         
-        self.stats = ServerStats()
+        try:
+            state = self.store.load() if self.store else None
+        except (OSError, ValueError, redis.exceptions.RedisError) as error:
+            self._logger.warning(f"Statistics could not be restored from {self.store}: {error}")
+            state = None
+        if not state or "types" not in state or "countries" not in state:
+            return ServerStats()
+        
+        self.restored = {"types": state["types"], "countries": state["countries"]}
+        for name, entries in state.get("windows", dict()).items():
+            if name in self.windows:
+                self.windows[name].load(entries)
+        
+        stats = ServerStats.from_counters(state["types"], state["countries"])
+        self._logger.info(
+            f"Restored the statistics of {utilities.colorize(stats.total, 'gold_1')} attacks from {self.store}")
+        return stats
+    
+    def save_statistics(self):
+        """ Saves the statistics every stats_interval seconds, when they changed """
+        saved = None
+        while True:
+            time.sleep(self.stats_interval)
+            try:
+                with self.stats.reading() as stats:
+                    total = stats.total
+                if total != saved and self.store_statistics(stats):
+                    saved = total
+            except Exception:
+                # persistence must outlive a failed save, the next one writes the whole statistics again
+                self._logger.exception(f"Statistics could not be saved to {self.store}")
+    
+    def store_statistics(self, stats: ServerStats) -> bool:
+        with stats.reading():
+            state = {
+                "types": stats.types,
+                "countries": stats.countries,
+                "windows": {name: window.dump() for name, window in self.windows.items()},
+            }
+        try:
+            self.store.save(state)
+            return True
+        except (OSError, ValueError, redis.exceptions.RedisError) as error:
+            self._logger.warning(f"Statistics could not be saved to {self.store}: {error}")
+            return False
+    
+    def start(self, watch_database: bool = True):
+        """
+        Restores the counters of the previous run and launches the threads that publish and save the statistics
+        
+        :param watch_database: reload the database on SIGHUP and when the file changes
+        """
+        self.store = self.open_stats_store() if self.stats_interval else None
+        self.stats = self.restore_statistics()
         
         self._logger.info(
             f"Proxy Server started at: "
             f"{utilities.colorize(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime()), 'gold_1')}"
         )
         self.start_time = timeit.default_timer()
+        # run_workers draws the epoch before starting its workers
+        if self.epoch is None:
+            self.epoch = int(time.time())
+        self.event_counter = itertools.count(1)
         
-        self.redis_pubsub: redis.client.PubSub = self.redis_watcher.server.pubsub()
-        self.redis_pubsub.subscribe(self.receive_channel)
-        
-        # after subscription the main thread launches a periodic task to send data on a stats channel
+        # a periodic task sends data on a stats channel
         thread = threading.Thread(target = self.send_statistics, args = ())
         thread.name = "stats-worker"
         thread.daemon = True  # Daemonize thread
         thread.start()  # Start the execution
         
+        # the statistics are saved in the background, never from the ingest loop
+        if self.store and self.stats_interval:
+            thread = threading.Thread(target = self.save_statistics, args = ())
+            thread.name = "stats-snapshotter"
+            thread.daemon = True
+            thread.start()
+        
+        if watch_database:
+            self.watch_database()
+    
+    def run(self, *args, **kwargs):
+        
+        self.start()
+        # attacks are published in pipelined batches, a batch waits at most publish_deadline seconds
+        self.publisher = utilities.PublishBatcher(
+            self.redis_watcher.server,
+            batch_size = self.publish_batch_size,
+            deadline = self.publish_deadline
+        )
+        
+        self.redis_pubsub: redis.client.PubSub = self.redis_watcher.server.pubsub()
+        self.redis_pubsub.subscribe(self.receive_channel)
+        
         self._logger.info(f"Listening on {utilities.colorize(self.receive_channel, 'yellow')} channel")
         
         subscription_msg_received: bool = False
@@ -268,7 +707,7 @@ class Proxy(object):
             
             if message:
                 if not message['type'] == "subscribe":
-                    data = json.loads(message['data'].decode('utf-8'))
+                    data = utilities.decode_attack(message['data'])
                     
                     if not self.verbose and not self.silent:
                         print("\033[A\033[K", end = '')
@@ -284,38 +723,21 @@ class Proxy(object):
                         f"Received data from {utilities.colorize(self.receive_channel, 'yellow_4a')} message id "
                         f"[{utilities.colorize(total_recv, 'gold_1')}]"
                     )
-                    self._logger.debug(f"\n{json.dumps(data, indent = 4)}")
-                    
-                    src_ip_info = self.get_info_of_ip_from_maxminddb(data['src']['ip'], prefix = "source")
-                    dst_ip_info = self.get_info_of_ip_from_maxminddb(data['dst']['ip'], prefix = "destination")
+                    if self._logger.isEnabledFor(logging.DEBUG):
+                        self._logger.debug(f"\n{json.dumps(data, indent = 4)}")
                     
-                    if src_ip_info and dst_ip_info:
-                        message = {
-                            "protocol": data['type'],
-                            "src": src_ip_info,
-                            "dst": dst_ip_info,
-                            "cve": data['cve'],
-                            "event_time": utilities.get_time(),
-                        }
-                        
-                        # Track Stats
-                        self.stats.update_type(message['protocol'])
-                        self.stats.update_country(src_ip_info["country"], message["protocol"], "incoming")
-                        self.stats.update_country(dst_ip_info["country"], message["protocol"], "outgoing")
-                        self.stats.export_stats()
-                        
-                        json_data = json.dumps(message)
-                        self.redis_watcher.server.publish(self.forward_channel, json_data)
+                    message = self.forge(data)
+                    if message:
+                        self.publisher.publish(self.forward_channel, message)
                         self._logger.info(
                             f"Published data to "
-                            f"{utilities.colorize(self.forward_channel)} channel"
+                            f"{utilities.colorize(self.forward_channel)} channel "
+                            f"[{utilities.colorize(f'{self.publisher.rate():.1f}', 'gold_1')} msg/s]"
                         )
                         previous_published = True
                         
-                        self._logger.debug(f"\n{json.dumps(message, indent = 4)}")
-                        
-                        # TODO: Later
-                        # self.stats.export_stats()
+                        if self._logger.isEnabledFor(logging.DEBUG):
+                            self._logger.debug(f"\n{json.dumps(utilities.loads(message), indent = 4)}")
                     else:
                         previous_published = False
                     
@@ -323,55 +745,492 @@ class Proxy(object):
                 else:
                     subscription_msg_received = True
     
-    def get_info_of_ip_from_maxminddb(self, ip, prefix = None) -> Optional[Dict]:
+    def run_workers(self, workers: int, batch_size: int = 64, batch_interval: float = 0.01):
+        """
+        Spreads the raw attacks over worker processes, each one with its own database reader and redis connection.
+        With pub/sub this process hands batches of undecoded messages to the workers in turn, with streams every
+        worker reads the raw stream as a member of the consumer group. Either way this process publishes the
+        statistics of all workers combined.
         
-        if not self.silent:
-            setattr(self._logger.handlers[0], 'terminator', '')
-            self._logger.info(f"Checking geolocation of {prefix} ip [{ip}]... ")
+        :param workers: number of worker processes
+        :param batch_size: messages handed to a worker at once
+        :param batch_interval: seconds a partial batch may wait for more messages
+        """
+        self.epoch = int(time.time())
+        
+        # workers are forked from a forkserver started before any thread of this process, a worker forked from this
+        # process once the stats threads run, e.g. a replacement, could inherit a lock one of them held for good
+        context = multiprocessing.get_context("forkserver")
+        outbox = context.Queue()
+        inboxes = list()
+        processes = list()
+        epochs = list()
+        worker_options = dict(
+            redis_ip = self.redis_watcher.ip,
+            redis_port = self.redis_watcher.port,
+            redis_socket = self.redis_socket,
+            redis_pool_size = self.redis_pool_size,
+            redis_health_check = self.redis_health_check,
+            database = self.path_geolite_db,
+            database_mode = self.geolite_db_mode,
+            database_reload_interval = self.reload_interval,
+            verbose = self.verbose,
+            silent = self.silent,
+            transport = self.transport,
+            stream_batch = self.stream_batch,
+            stream_maxlen = self.stream_maxlen,
+            stats_mode = self.stats_mode,
+            stats_snapshot_every = self.stats_snapshot_every,
+            geo_cache_size = self.geo_cache_size,
+            geo_cache_ttl = self.geo_cache_ttl,
+            geo_index = self.use_geo_index,
+            geo_index_path = self.geo_index_path,
+            codec = self.codec
+        )
+        
+        def spawn(index: int) -> multiprocessing.Process:
+            process = context.Process(
+                target = run_worker,
+                name = f"proxy-worker-{index}",
+                args = (index, workers, epochs[index], worker_options, inboxes[index], outbox),
+                daemon = True
+            )
+            process.start()
+            return process
+        
+        def revive(index: int):
+            """ Replaces a worker that died """
+            if processes[index].is_alive():
+                return
+            self._logger.error(
+                f"Worker {processes[index].name} exited with code {processes[index].exitcode}, restarting it")
+            if inboxes[index] is not None:
+                # the dead worker may have held the lock of its inbox, the batches left in it are lost
+                inboxes[index].cancel_join_thread()
+                inboxes[index] = context.Queue(maxsize = 1024)
+            # a later epoch, the ids the dead worker already drew are not drawn again
+            epochs[index] = max(int(time.time()), epochs[index] + 1)
+            processes[index] = spawn(index)
+        
+        for index in range(workers):
+            inboxes.append(context.Queue(maxsize = 1024) if self.transport == "pubsub" else None)
+            epochs.append(self.epoch)
+            processes.append(spawn(index))
+        
+        # workers reload their own reader, this process only forwards SIGHUP to them
+        self.start(watch_database = False)
+        
+        def forward(signum, frame):
+            for worker in processes:
+                if worker.is_alive():
+                    os.kill(worker.pid, signum)
+        
+        signal.signal(signal.SIGHUP, forward)
+        
+        thread = threading.Thread(target = self.collect_statistics, args = (outbox,))
+        thread.name = "stats-collector"
+        thread.daemon = True
+        thread.start()
+        
+        if self.transport == "streams":
+            self._logger.info(
+                f"Reading {utilities.colorize(self.receive_channel, 'yellow')} stream "
+                f"with {utilities.colorize(workers, 'gold_1')} workers"
+            )
+            try:
+                while True:
+                    time.sleep(1)
+                    for index in range(workers):
+                        revive(index)
+            finally:
+                for process in processes:
+                    process.terminate()
+            return
+        
+        self.redis_pubsub: redis.client.PubSub = self.redis_watcher.server.pubsub()
+        self.redis_pubsub.subscribe(self.receive_channel)
+        self._logger.info(
+            f"Listening on {utilities.colorize(self.receive_channel, 'yellow')} channel "
+            f"with {utilities.colorize(workers, 'gold_1')} workers"
+        )
+        
+        batch: List[bytes] = list()
+        batch_started: float = 0.0
+        last_check: float = time.monotonic()
+        turn = 0
+        try:
+            while True:
+                message = self.redis_pubsub.get_message(timeout = batch_interval)
+                if message and message['type'] == "message":
+                    if not batch:
+                        batch_started = time.monotonic()
+                    batch.append(message['data'])
+                
+                if batch and (
+                        len(batch) >= batch_size or not message or time.monotonic() - batch_started >= batch_interval
+                ):
+                    # a full inbox is either a slow worker or a dead one, which would block ingestion for good
+                    while True:
+                        try:
+                            inboxes[turn].put(batch, timeout = 1)
+                            break
+                        except queue.Full:
+                            revive(turn)
+                    turn = (turn + 1) % workers
+                    batch = list()
+                
+                if time.monotonic() - last_check >= 1:
+                    last_check = time.monotonic()
+                    for index in range(workers):
+                        revive(index)
+        finally:
+            for inbox in inboxes:
+                inbox.put(None)
+            for process in processes:
+                process.join(timeout = 5)
+    
+    def collect_statistics(self, outbox: multiprocessing.Queue):
+        """ Keeps self.stats equal to the combined statistics that the workers report """
+        # keyed by process, the latest counts of a worker that died are kept next to those of its replacement
+        snapshots: Dict[int, Dict[str, Dict]] = dict()
+        while True:
+            pid, snapshot = outbox.get()
+            snapshots[pid] = snapshot
+            # the workers count from zero, on top of the statistics restored at startup
+            combined = ServerStats.combine(([self.restored] if self.restored else []) + list(snapshots.values()))
+            # swapped at once, the stats thread sees either the previous or the new counters
+            self.stats = ServerStats.from_counters(combined["types"], combined["countries"])
+    
+    def work(self, index: int, workers: int, epoch: int, inbox: Optional[multiprocessing.Queue],
+             outbox: multiprocessing.Queue, report_interval: float = 1.0):
+        """
+        Loop of a worker process: forges the batches of the inbox, or of the raw stream when there is no inbox,
+        and reports its statistics to the outbox
+        
+        :param index: index of this worker, ids of its events are index + 1 modulo workers
+        :param workers: number of workers
+        :param epoch: epoch of the coordinating proxy
+        :param report_interval: seconds between two reports of statistics
+        """
+        self.stats = ServerStats()
+        self.start_time = timeit.default_timer()
+        self.epoch = epoch
+        # workers draw interleaved ids, so ids are unique and increase for the messages of each worker
+        self.event_counter = itertools.count(index + 1, workers)
+        self.watch_database()
+        
+        last_report = time.monotonic()
+        
+        def report():
+            nonlocal last_report
+            now = time.monotonic()
+            if now - last_report >= report_interval:
+                with self.stats.reading() as stats:
+                    outbox.put((os.getpid(), {"types": stats.types, "countries": stats.countries}))
+                last_report = now
+        
+        if inbox is None:
+            self.consume_stream(consumer = f"{socket.gethostname()}-{index}", on_batch = report)
+            return
+        
+        pipeline = self.redis_watcher.server.pipeline(transaction = False)
+        for batch in iter(inbox.get, None):
+            for raw in batch:
+                try:
+                    message = self.forge(utilities.decode_attack(raw), quiet = True)
+                except (ValueError, KeyError, TypeError) as error:
+                    self._logger.warning(f"Dropped a malformed attack: {error!r}")
+                    continue
+                if message:
+                    pipeline.publish(self.forward_channel, message)
+            try:
+                pipeline.execute()
+            except redis.exceptions.RedisError as error:
+                self._logger.error(f"Batch of {len(batch)} attacks could not be published: {error!r}")
+            report()
+    
+    def run_streams(self):
+        """ Reads the raw attacks stream in batches as a member of the proxies consumer group """
+        self.start()
+        self._logger.info(
+            f"Reading {utilities.colorize(self.receive_channel, 'yellow')} stream "
+            f"in batches of up to {utilities.colorize(self.stream_batch, 'gold_1')} messages"
+        )
+        self.consume_stream(consumer = f"{socket.gethostname()}-0")
+    
+    def consume_stream(self, consumer: str, on_batch: Optional[Callable[[], None]] = None, block: int = 5000):
+        """
+        Reads batches of raw attacks with XREADGROUP, appends the forged messages to the forward stream and
+        acknowledges the batch in the same round trip. Entries this consumer read but never acknowledged,
+        e.g. because the proxy was restarted, are processed first. Entries that cannot be decoded or forged are
+        acknowledged too and moved to the dead letters stream.
+        
+        :param consumer: name of this reader in the consumer group, stable across restarts
+        :param on_batch: called after every batch
+        :param block: milliseconds to wait for new entries
+        """
+        server: redis.Redis = self.redis_watcher.server
+        
+        def create_group():
+            try:
+                server.xgroup_create(self.receive_channel, utilities.STREAM_GROUP, id = "$", mkstream = True)
+            except redis.exceptions.ResponseError as error:
+                if "BUSYGROUP" not in str(error):
+                    raise
         
-        def clean_ip(ip_info):
-            """Create clean dictionary using unclean db dictionary contents"""
-            if not ip_info:
-                return dict()
+        create_group()
+        dead_letters = f"{self.receive_channel}{utilities.DEAD_LETTERS_SUFFIX}"
+        pipeline = server.pipeline(transaction = False)
+        last_id = "0"  # pending entries of this consumer first, then new ones
+        backoff = 0.0
+        while True:
+            try:
+                if backoff:
+                    # a redis that restarted without persistence lost the group too
+                    create_group()
+                response = server.xreadgroup(
+                    utilities.STREAM_GROUP,
+                    consumer,
+                    {self.receive_channel: last_id},
+                    count = self.stream_batch,
+                    block = block
+                )
+                entries = response[0][1] if response else list()
+                if last_id == "0" and not entries:
+                    last_id = ">"
+                
+                if entries:
+                    for entry_id, fields in entries:
+                        raw = fields.get(b"data")
+                        if raw is None:
+                            continue
+                        try:
+                            message = self.forge(utilities.decode_attack(raw), quiet = True)
+                        except (ValueError, KeyError, TypeError) as error:
+                            # acknowledged with the batch, a malformed entry must not stop the consumer on every
+                            # restart
+                            self._logger.warning(
+                                f"Moving malformed entry {entry_id.decode()} to {dead_letters}: {error!r}")
+                            pipeline.xadd(
+                                dead_letters,
+                                {"id": entry_id, "data": raw, "error": repr(error)},
+                                maxlen = self.stream_maxlen,
+                                approximate = True
+                            )
+                            continue
+                        if message:
+                            pipeline.xadd(
+                                self.forward_channel,
+                                {"data": message},
+                                maxlen = self.stream_maxlen,
+                                approximate = True
+                            )
+                    pipeline.xack(
+                        self.receive_channel, utilities.STREAM_GROUP, *[entry_id for entry_id, _ in entries])
+                    pipeline.execute()
+            except redis.exceptions.RedisError as error:
+                # e.g. redis restarted or failed over, the batch that was not acknowledged is pending and read
+                # again, its attacks may be forwarded twice
+                backoff = min(backoff * 2, 30.0) if backoff else 0.5
+                self._logger.error(
+                    f"Reading {self.receive_channel} stream failed, retrying in {backoff:.1f}s: {error}")
+                pipeline.reset()
+                last_id = "0"
+                time.sleep(backoff)
+                continue
+            backoff = 0.0
             
-            selected = {
-                "continent": ip_info.get("continent", dict()).get("names", dict()).get("en", None),
-                "continent_code": ip_info.get("continent", dict()).get("code", None),
-                "country": ip_info.get("country", dict()).get("names", dict()).get("en", None),
-                "city": ip_info.get("city", dict()).get("names", dict()).get("en", None),
-                "iso_code": ip_info.get("country", dict()).get("iso_code", None),
-                "latitude": ip_info.get("location", dict()).get("latitude", None),
-                "longitude": ip_info.get("location", dict()).get("longitude", None),
-            }
+            if on_batch:
+                on_batch()
+    
+    async def run_async(self, max_in_flight: int = 1024, report_interval: float = 5.0):
+        """
+        asyncio flavor of run: messages are awaited instead of polled and publishing does not wait for a reply
+        from redis before the next message is processed, so throughput is bound by redis and the geo lookups.
+        
+        :param max_in_flight: publishes that may wait for their reply before ingestion pauses
+        :param report_interval: seconds between two throughput reports
+        """
+        self.start()
+        
+        # the pool subscribes on a connection of its own, publishing holds one of the others so the publishes are
+        # futures pipelined on that connection rather than coroutines waiting for a free connection
+        pool: aioredis.Redis = await RedisWatcher.async_pool(self.redis_watcher.address, db = self.redis_watcher.db)
+        connection = await pool.connection.acquire()
+        publisher = aioredis.Redis(connection)
+        in_flight: Deque[asyncio.Future] = deque()
+        
+        def published(future: asyncio.Future):
+            if not future.cancelled() and future.exception():
+                self._logger.error(f"Could not publish to {self.forward_channel}: {future.exception()!r}")
+        
+        try:
+            channel, = await pool.subscribe(self.receive_channel)
+            self._logger.info(f"Listening on {utilities.colorize(self.receive_channel, 'yellow')} channel")
             
-            return selected
+            total_recv = 0
+            total_published = 0
+            last_report = time.monotonic()
+            while await channel.wait_message():
+                raw = await channel.get()
+                total_recv += 1
+                
+                data = utilities.decode_attack(raw)
+                if self._logger.isEnabledFor(logging.DEBUG):
+                    self._logger.debug(f"\n{json.dumps(data, indent = 4)}")
+                
+                message = self.forge(data, quiet = True)
+                if message:
+                    future = publisher.publish(self.forward_channel, message)
+                    future.add_done_callback(published)
+                    in_flight.append(future)
+                    total_published += 1
+                    
+                    while in_flight and in_flight[0].done():
+                        in_flight.popleft()
+                    if len(in_flight) >= max_in_flight:
+                        await asyncio.wait([in_flight.popleft()])
+                
+                now = time.monotonic()
+                if now - last_report >= report_interval:
+                    self._logger.info(
+                        f"Received {utilities.colorize(total_recv, 'gold_1')} "
+                        f"published {utilities.colorize(total_published, 'gold_1')} messages "
+                        f"[{utilities.colorize(f'{total_recv / (now - last_report):.1f}', 'gold_1')} msg/s]"
+                    )
+                    if self.geo_cache is not None:
+                        self._logger.info(f"Geolocation cache {self.geo_cache.counters()}")
+                    total_recv = 0
+                    total_published = 0
+                    last_report = now
+        finally:
+            if in_flight:
+                await asyncio.wait(list(in_flight))
+            pool.connection.release(connection)
+            await RedisWatcher.close_async_pool(self.redis_watcher.address, db = self.redis_watcher.db)
+    
+    def forge(self, data: Dict, quiet: bool = False) -> Optional[bytes]:
+        """
+        Geolocates both ends of a raw attack and tracks its statistics
+        
+        The message is assembled from serialized fragments rather than serialized as a whole: locations come from
+        the geolocation cache or index as shared records whose JSON is cached, the protocols are a handful and the
+        event time changes once a second, so only the id and the CVE are serialized for each attack. The id is the
+        first key, where the SSE servers look for it.
+        
+        :param data: raw attack as published by the attacks generator
+        :param quiet: skips the interactive messages of the lookups
+        :return: the JSON message to publish or None if an end could not be geolocated
+        """
+        if self._retired_databases:
+            self.close_retired_databases()
+        
+        src_ip_info = self.get_info_of_ip_from_maxminddb(data['src']['ip'], prefix = "source", quiet = quiet)
+        dst_ip_info = self.get_info_of_ip_from_maxminddb(data['dst']['ip'], prefix = "destination", quiet = quiet)
+        
+        if not src_ip_info or not dst_ip_info:
+            return None
+        
+        protocol = data['type']
+        protocol_fragment = self.protocol_fragments.get(protocol)
+        if protocol_fragment is None:
+            protocol_fragment = self.protocol_fragments[protocol] = utilities.dumps(protocol)
+        
+        if self.geo_index is not None or self.geo_cache is not None:
+            src_fragment = self.fragments.get(src_ip_info)
+            dst_fragment = self.fragments.get(dst_ip_info)
+        else:
+            # records read straight from the database are new objects on every lookup
+            src_fragment = utilities.dumps(src_ip_info)
+            dst_fragment = utilities.dumps(dst_ip_info)
+        
+        second = int(time.time())
+        if second != self.event_second:
+            self.event_second = second
+            self.event_time_fragment = utilities.dumps(utilities.get_time())
+        
+        message = b"".join((
+            b'{"id":"', self.next_event_id().encode(),
+            b'","protocol":', protocol_fragment,
+            b',"src":', src_fragment,
+            b',"dst":', dst_fragment,
+            b',"cve":', utilities.dumps(data['cve']),
+            b',"event_time":', self.event_time_fragment,
+            b'}'
+        ))
+        
+        # Track Stats
+        self.stats.record(protocol, src_ip_info["country"], dst_ip_info["country"])
+        
+        return message
+    
+    def next_event_id(self) -> str:
+        """
+        Id of the next published event, assigned once here so every SSE server sends the same id to its clients.
+        The epoch prefix keeps ids increasing across proxy restarts.
+        """
+        return f"{self.epoch}-{next(self.event_counter)}"
+    
+    def get_info_of_ip_from_maxminddb(self, ip, prefix = None, quiet: bool = False) -> Optional[Dict]:
+        
+        interactive = not self.silent and not quiet
+        if interactive:
+            setattr(self._logger.handlers[0], 'terminator', '')
+            self._logger.info(f"Checking geolocation of {prefix} ip [{ip}]... ")
         
         try:
-            unclean_ip_info = self.geolite_db.get(ip)
-            self._logger.debug(f"unclean ip info \n{json.dumps(unclean_ip_info, indent = 4)}")
-            clean_ip_info = clean_ip(unclean_ip_info)
-            if not clean_ip_info.get("latitude") and not clean_ip_info.get("longitude"):
-                if not self.silent:
+            if self.geo_index is not None:
+                clean_ip_info = self.geo_index.get(ip)
+            elif self.geo_cache is not None:
+                clean_ip_info = self.geo_cache.get(ip)
+            else:
+                unclean_ip_info = self.geolite_db.get(ip)
+                if self._logger.isEnabledFor(logging.DEBUG):
+                    self._logger.debug(f"unclean ip info \n{json.dumps(unclean_ip_info, indent = 4)}")
+                clean_ip_info = located(clean_ip(unclean_ip_info))
+            
+            if not clean_ip_info:
+                if interactive:
                     print(f"no data found")
                     setattr(self._logger.handlers[0], 'terminator', '\n')
                 return None
             
-            if not self.silent:
+            if interactive:
                 print("data found")
                 setattr(self._logger.handlers[0], 'terminator', '\n')
-                self._logger.debug(f"\n{json.dumps(clean_ip_info, indent = 4)}")
+                if self._logger.isEnabledFor(logging.DEBUG):
+                    self._logger.debug(f"\n{json.dumps(clean_ip_info, indent = 4)}")
             
             return clean_ip_info
         except ValueError:
+            if interactive:
+                print("invalid")
+                setattr(self._logger.handlers[0], 'terminator', '\n')
             self._logger.warning(f"Looked up for an invalid IP address.")
             return None
     
+    def locate(self, ip: str) -> Optional[Dict]:
+        """ Cleaned record of ip read straight from the database """
+        return located(clean_ip(self.geolite_db.get(ip)))
+    
     def connect_to_database(self) -> Optional[maxminddb.reader.Reader]:
         try:
-            self.geolite_db: maxminddb.reader.Reader = maxminddb.open_database(
-                database = self.path_geolite_db,
-                mode = maxminddb.MODE_FILE
-            )
+            try:
+                self.geolite_db: maxminddb.reader.Reader = open_reader(self.path_geolite_db, self.geolite_db_mode)
+            except ValueError:
+                if self.geolite_db_mode != "c-ext":
+                    raise
+                self._logger.warning("maxminddb C extension is not available, the database is memory mapped instead")
+                self.geolite_db_mode = "mmap"
+                self.geolite_db = open_reader(self.path_geolite_db, self.geolite_db_mode)
+            if self.geo_cache_size:
+                self.geo_cache = GeoCache(self.geolite_db, size = self.geo_cache_size, ttl = self.geo_cache_ttl)
+            if self.use_geo_index:
+                self.geo_index = PrefixIndex.open(self.path_geolite_db, self.geo_index_path, logger = self._logger)
+                # IPv6 addresses are not indexed
+                self.geo_index.fallback = self.geo_cache.get if self.geo_cache is not None else self.locate
+                self._logger.info(
+                    f"Network index of {utilities.colorize(len(self.geo_index), 'gold_1')} IPv4 networks loaded")
         except FileNotFoundError:
             self._logger.warning(f"MaxMind database file: {self.path_geolite_db} could not be found")
             # ask the user to switch to manual IP mode
@@ -386,20 +1245,131 @@ class Proxy(object):
         
         return None
     
+    def watch_database(self):
+        """ Reloads the database on SIGHUP and, with a reload interval, when the database file is replaced """
+        def reload(signum, frame):
+            # the handler interrupts the main thread, the reload itself happens next to it
+            thread = threading.Thread(target = self.reload_database, args = ())
+            thread.name = "database-reload"
+            thread.daemon = True
+            thread.start()
+        
+        # only the main thread may install signal handlers, a proxy started from another thread relies on polling
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGHUP, reload)
+        else:
+            self._logger.info("Proxy runs outside of the main thread, SIGHUP does not reload the MaxMind database")
+        
+        if self.reload_interval:
+            thread = threading.Thread(target = self.poll_database, args = ())
+            thread.name = "database-watcher"
+            thread.daemon = True
+            thread.start()
+    
+    def poll_database(self):
+        """ Reloads the database whenever its file changes, until the reload succeeds """
+        signature = self.database_signature()
+        while True:
+            time.sleep(self.reload_interval)
+            current = self.database_signature()
+            if current and current != signature and self.reload_database():
+                signature = current
+    
+    def database_signature(self) -> Optional[tuple]:
+        """ Identity of the database file, which changes when the file is rewritten or replaced """
+        try:
+            stat = os.stat(self.path_geolite_db)
+        except (OSError, TypeError):
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+    
+    def reload_database(self) -> bool:
+        """
+        Opens the database again and swaps it in without pausing ingestion: the new reader, cache and index are
+        prepared beside the ones in use, the cache warmed with the networks cached so far, then the references
+        are swapped. The previous reader is closed by the ingest loop between two messages.
+        
+        :return: True if the new database is in use
+        """
+        if not self._reload_lock.acquire(blocking = False):
+            self._logger.info("MaxMind database is already being reloaded")
+            return False
+        
+        reader = None
+        try:
+            started = timeit.default_timer()
+            reader = open_reader(self.path_geolite_db, self.geolite_db_mode)
+            
+            geo_cache = None
+            if self.geo_cache_size:
+                geo_cache = GeoCache(reader, size = self.geo_cache_size, ttl = self.geo_cache_ttl)
+                if self.geo_cache is not None:
+                    geo_cache.warm(self.geo_cache.addresses())
+            
+            geo_index = None
+            if self.use_geo_index:
+                # built by another process if the database is new, ingestion goes on at full speed meanwhile
+                geo_index = PrefixIndex.open(
+                    self.path_geolite_db,
+                    self.geo_index_path,
+                    logger = self._logger,
+                    in_process = False
+                )
+                geo_index.fallback = geo_cache.get if geo_cache is not None else lambda ip: located(clean_ip(reader.get(ip)))
+            
+            retired = self.geolite_db
+            self.update_options(geolite_db = reader, geo_cache = geo_cache, geo_index = geo_index)
+            if retired:
+                self._retired_databases.append(retired)
+            
+            self._logger.info(
+                f"MaxMind database built at "
+                f"{utilities.colorize(time.strftime('%Y-%m-%d', time.gmtime(reader.metadata().build_epoch)), 'gold_1')} "
+                f"reloaded in {utilities.colorize(f'{timeit.default_timer() - started:.2f}', 'gold_1')}s"
+            )
+            return True
+        except (OSError, ValueError, maxminddb.InvalidDatabaseError) as error:
+            self._logger.warning(f"MaxMind database {self.path_geolite_db} could not be reloaded: {error}")
+            if reader:
+                reader.close()
+            return False
+        finally:
+            self._reload_lock.release()
+    
+    def close_retired_databases(self):
+        while self._retired_databases:
+            self._retired_databases.pop().close()
+    
     def disconnect_from_database(self):
         self.geolite_db.close()
+        self.close_retired_databases()
     
     def shutdown(self):
         if not self.silent and self._logger:
             setattr(self._logger.handlers[0], 'terminator', '\n')
         self._logger.info("Stopping Proxy Server")
         
+        # the counters since the latest save survive the restart as well
+        if self.store and self.stats_interval and self.stats:
+            self.store_statistics(self.stats)
+        
+        if self.publisher is not None:
+            self.publisher.close()
+            self._logger.info(
+                f"Published {utilities.colorize(self.publisher.published, 'gold_1')} messages in "
+                f"{utilities.colorize(self.publisher.batches, 'gold_1')} batches "
+                f"[{utilities.colorize(f'{self.publisher.rate():.1f}', 'gold_1')} msg/s]"
+            )
+        
         if self.redis_watcher:
             self.redis_watcher.disconnect()
         
         if self.geolite_db:
             self.disconnect_from_database()
         
+        if self.geo_cache is not None:
+            self._logger.info(f"Geolocation cache {self.geo_cache.counters()}")
+        
         self._logger.info(f"Proxy Server {utilities.colorize('successfully', 'gold_1')} stopped")
         
         self.end_time = timeit.default_timer()
@@ -415,9 +1385,11 @@ class Proxy(object):
                 f"{utilities.colorize(f'{self.total_time}', color = 'gold_1')}"
             )  # Time in days, hours:minutes:seconds.milliseconds format
             
+            with self.stats.reading() as stats:
+                total = stats.total
             self._logger.info(
                 "Total IPs published "
-                f"{utilities.colorize(self.stats.types['TOTAL'], 'gold_1')}"
+                f"{utilities.colorize(total, 'gold_1')}"
             )
     
     def wait_counter(self):
@@ -440,6 +1412,38 @@ class Proxy(object):
     def geolite_db(self, value):
         self.update_options(geolite_db = value)
     
+    @property
+    def geo_cache(self) -> Optional[GeoCache]:
+        return self.options.geo_cache
+    
+    @geo_cache.setter
+    def geo_cache(self, value):
+        self.update_options(geo_cache = value)
+    
+    @property
+    def geo_index(self) -> Optional[PrefixIndex]:
+        return self.options.geo_index
+    
+    @geo_index.setter
+    def geo_index(self, value):
+        self.update_options(geo_index = value)
+    
+    @property
+    def use_geo_index(self):
+        return self.options.use_geo_index
+    
+    @property
+    def geo_index_path(self):
+        return self.options.geo_index_path
+    
+    @property
+    def geo_cache_size(self):
+        return self.options.geo_cache_size
+    
+    @property
+    def geo_cache_ttl(self):
+        return self.options.geo_cache_ttl
+    
     @property
     def platform(self):
         return self.options.platform
@@ -468,6 +1472,14 @@ class Proxy(object):
     def start_time(self, value):
         self.update_options(start_time = value)
     
+    @property
+    def epoch(self):
+        return self.options.epoch
+    
+    @epoch.setter
+    def epoch(self, value):
+        self.update_options(epoch = value)
+    
     @property
     def end_time(self):
         return self.options.end_time
@@ -500,6 +1512,18 @@ class Proxy(object):
     def stats_channel(self, value):
         self.update_options(stats_channel = value)
     
+    @property
+    def reload_interval(self):
+        return self.options.reload_interval
+    
+    @property
+    def geolite_db_mode(self):
+        return self.options.geolite_db_mode
+    
+    @geolite_db_mode.setter
+    def geolite_db_mode(self, value):
+        self.update_options(geolite_db_mode = value)
+    
     @property
     def path_geolite_db(self):
         return self.options.path_geolite_db
@@ -532,6 +1556,78 @@ class Proxy(object):
     def silent(self, value):
         self.update_options(silent = value)
     
+    @property
+    def transport(self):
+        return self.options.transport
+    
+    @property
+    def stream_batch(self):
+        return self.options.stream_batch
+    
+    @property
+    def stream_maxlen(self):
+        return self.options.stream_maxlen
+    
+    @property
+    def redis_socket(self):
+        return self.options.redis_socket
+    
+    @property
+    def redis_pool_size(self):
+        return self.options.redis_pool_size
+    
+    @property
+    def redis_health_check(self):
+        return self.options.redis_health_check
+    
+    @property
+    def publish_batch_size(self):
+        return self.options.publish_batch_size
+    
+    @property
+    def publish_deadline(self):
+        return self.options.publish_deadline
+    
+    @property
+    def publisher(self) -> Optional[utilities.PublishBatcher]:
+        return self.options.publisher
+    
+    @publisher.setter
+    def publisher(self, value):
+        self.update_options(publisher = value)
+    
+    @property
+    def codec(self):
+        return self.options.codec
+    
+    @property
+    def stats_mode(self):
+        return self.options.stats_mode
+    
+    @property
+    def stats_snapshot_every(self):
+        return self.options.stats_snapshot_every
+    
+    @property
+    def stats_file(self):
+        return self.options.stats_file
+    
+    @property
+    def stats_interval(self):
+        return self.options.stats_interval
+    
+    @property
+    def stats_format(self):
+        return self.options.stats_format
+    
+    @property
+    def stats_store(self):
+        return self.options.stats_store
+    
+    @property
+    def stats_key(self):
+        return self.options.stats_key
+    
     @property
     def stats(self):
         return self.options.stats
@@ -543,6 +1639,16 @@ class Proxy(object):
     # endregion
 
 
+def run_worker(index: int, workers: int, epoch: int, options: Dict[str, Any], inbox: multiprocessing.Queue,
+               outbox: multiprocessing.Queue):
+    """ Entry point of a proxy worker process """
+    proxy = Proxy(**options)
+    try:
+        proxy.work(index, workers, epoch, inbox, outbox)
+    except KeyboardInterrupt:
+        pass
+
+
 def validate_ip(ctx, param, value: str):
     if value.lower() == "localhost":
         return "127.0.0.1"
@@ -592,6 +1698,32 @@ def validate_ip(ctx, param, value: str):
     help = "Redis-server port (range is 1024 - 49151)"
 )
 # endregion
+# region redis-socket option
+@click.option(
+    "--redis-socket",
+    default = None,
+    metavar = "<File Path>",
+    help = "Unix socket of a redis-server on the same host, used instead of --redis-ip and --redis-port"
+)
+# endregion
+# region redis-pool-size option
+@click.option(
+    "--redis-pool-size",
+    default = 64,
+    metavar = "<integer>",
+    type = click.IntRange(1, None),
+    help = "Connections of the redis pool shared by the components of the process"
+)
+# endregion
+# region redis-health-check option
+@click.option(
+    "--redis-health-check",
+    default = 30.0,
+    metavar = "<seconds>",
+    type = click.FloatRange(0, None),
+    help = "Seconds a redis connection may be idle before it is checked on reuse (0 disables the checks)"
+)
+# endregion
 # region db option
 @click.option(
     "-db",
@@ -605,6 +1737,27 @@ def validate_ip(ctx, param, value: str):
     help = "Path to maxmind database"
 )
 # endregion
+# region db-mode option
+@click.option(
+    "--db-mode",
+    "database_mode",
+    default = "mmap",
+    type = click.Choice(list(DATABASE_MODES)),
+    help = "How the maxmind database is read: memory mapped and shared between processes, loaded in memory, "
+           "read from the file per lookup, picked automatically or through the C extension"
+)
+# endregion
+# region db-reload-interval option
+@click.option(
+    "--db-reload-interval",
+    "database_reload_interval",
+    default = 0,
+    metavar = "<seconds>",
+    type = click.FloatRange(0, None),
+    help = "Seconds between two checks of the maxmind database file for a new version, "
+           "0 reloads it only on SIGHUP"
+)
+# endregion
 # region logs option
 @click.option(
     "-l",
@@ -642,28 +1795,240 @@ def validate_ip(ctx, param, value: str):
     help = "Disables ALL logging messages"
 )
 # endregion
+# region asyncio option
+@click.option(
+    "--asyncio",
+    "asyncio_mode",
+    metavar = "<switch>",
+    is_flag = True,
+    help = "Awaits messages with asyncio instead of polling, reporting throughput instead of every message"
+)
+# endregion
+# region transport option
+@click.option(
+    "-t",
+    "--transport",
+    default = "pubsub",
+    type = click.Choice(utilities.TRANSPORTS),
+    help = "Read and publish attacks through pub/sub channels or through redis streams"
+)
+# endregion
+# region stream-batch option
+@click.option(
+    "--stream-batch",
+    default = 100,
+    metavar = "<integer>",
+    type = click.IntRange(1, None),
+    help = "Maximum number of entries read from the raw attacks stream at once"
+)
+# endregion
+# region stream-maxlen option
+@click.option(
+    "--stream-maxlen",
+    default = 10000,
+    metavar = "<integer>",
+    type = click.IntRange(1, None),
+    help = "Approximate number of attacks kept in the forward stream, the replay log of the SSE servers"
+)
+# endregion
+# region publish-batch-size option
+@click.option(
+    "--publish-batch-size",
+    default = 64,
+    metavar = "<integer>",
+    type = click.IntRange(1, None),
+    help = "Attacks published in one redis pipeline, 1 publishes every attack on its own"
+)
+# endregion
+# region publish-deadline option
+@click.option(
+    "--publish-deadline",
+    default = 0.01,
+    metavar = "<seconds>",
+    type = click.FloatRange(0, None),
+    help = "Seconds an attack may wait for its publishing batch to fill up"
+)
+# endregion
+# region stats-mode option
+@click.option(
+    "--stats-mode",
+    default = "full",
+    type = click.Choice(STATS_MODES),
+    help = "Publish the full statistics on every tick or full snapshots with deltas of the changed counters in between"
+)
+# endregion
+# region stats-snapshot-every option
+@click.option(
+    "--stats-snapshot-every",
+    default = 20,
+    metavar = "<integer>",
+    type = click.IntRange(1, None),
+    help = "Ticks between two full snapshots of the statistics in delta mode"
+)
+# endregion
+# region stats-file option
+@click.option(
+    "--stats-file",
+    default = "cybermap_stats.json",
+    metavar = "<File Path>",
+    type = click.Path(dir_okay = False),
+    help = "File the statistics are saved to, relative paths are in /var/log/cybermap"
+)
+# endregion
+# region stats-interval option
+@click.option(
+    "--stats-interval",
+    default = 10.0,
+    metavar = "<seconds>",
+    type = click.FloatRange(0, None),
+    help = "Seconds between two saves of the statistics, 0 disables saving and restoring them"
+)
+# endregion
+# region stats-format option
+@click.option(
+    "--stats-format",
+    default = "json",
+    type = click.Choice(STATS_FORMATS),
+    help = "Write the statistics file indented or on a single line"
+)
+# endregion
+# region stats-store option
+@click.option(
+    "--stats-store",
+    default = "file",
+    type = click.Choice(STATS_STORES),
+    help = "Save the statistics to the stats file or to a redis hash, they are restored from there at startup"
+)
+# endregion
+# region stats-key option
+@click.option(
+    "--stats-key",
+    default = "cybermap:stats",
+    metavar = "<key>",
+    help = "Redis hash of the statistics with the redis stats store"
+)
+# endregion
+# region geo-cache-size option
+@click.option(
+    "--geo-cache-size",
+    default = 65536,
+    metavar = "<integer>",
+    type = click.IntRange(0, None),
+    help = "Number of networks kept in the geolocation cache (0 disables the cache)"
+)
+# endregion
+# region geo-cache-ttl option
+@click.option(
+    "--geo-cache-ttl",
+    default = 0,
+    metavar = "<float>",
+    type = click.FloatRange(0, None),
+    help = "Seconds a network stays in the geolocation cache (0 keeps it until evicted)"
+)
+# endregion
+# region geo-index option
+@click.option(
+    "--geo-index",
+    metavar = "<switch>",
+    is_flag = True,
+    help = "Look IPv4 addresses up in a sorted index of the database networks, built once and saved to disk"
+)
+# endregion
+# region geo-index-path option
+@click.option(
+    "--geo-index-path",
+    type = click.Path(
+        file_okay = True,
+        dir_okay = False
+    ),
+    metavar = "<File Path>",
+    default = None,
+    help = "File of the saved network index (default: the database path with an .index suffix)"
+)
+# endregion
+# region codec option
+@click.option(
+    "--codec",
+    default = None,
+    type = click.Choice(utilities.available_codecs()),
+    help = f"JSON library of the messages (default: {utilities.get_codec().name})"
+)
+# endregion
+# region workers option
+@click.option(
+    "-w",
+    "--workers",
+    default = 1,
+    metavar = "<integer>",
+    type = click.IntRange(1, None),
+    help = "Number of worker processes that geolocate the attacks"
+)
+# endregion
 @click.pass_context
 # endregion
-def main(ctx, redis_ip: str, redis_port: int, database: pathlib.Path, logs: pathlib.Path, verbose: bool, silent: bool,
-         demo: bool):
+def main(ctx, redis_ip: str, redis_port: int, redis_socket: Optional[str], redis_pool_size: int,
+         redis_health_check: float, database: pathlib.Path, database_mode: str,
+         database_reload_interval: float, logs: pathlib.Path, verbose: bool, silent: bool,
+         demo: bool, asyncio_mode: bool, transport: str, stream_batch: int, stream_maxlen: int,
+         publish_batch_size: int, publish_deadline: float, stats_mode: str,
+         stats_snapshot_every: int, stats_file: str, stats_interval: float, stats_format: str, stats_store: str,
+         stats_key: str,
+         geo_cache_size: int, geo_cache_ttl: float, geo_index: bool, geo_index_path: Optional[str], codec: Optional[str],
+         workers: int):
     try:
+        proxy: Proxy = Proxy(
+            redis_ip = redis_ip,
+            redis_port = redis_port,
+            redis_socket = redis_socket,
+            redis_pool_size = redis_pool_size,
+            redis_health_check = redis_health_check,
+            database = database,
+            database_mode = database_mode,
+            database_reload_interval = database_reload_interval,
+            verbose = verbose,
+            silent = silent,
+            transport = transport,
+            stream_batch = stream_batch,
+            stream_maxlen = stream_maxlen,
+            publish_batch_size = publish_batch_size,
+            publish_deadline = publish_deadline,
+            stats_mode = stats_mode,
+            stats_snapshot_every = stats_snapshot_every,
+            stats_file = stats_file,
+            stats_interval = stats_interval,
+            stats_format = stats_format,
+            stats_store = stats_store,
+            stats_key = stats_key,
+            geo_cache_size = geo_cache_size,
+            geo_cache_ttl = geo_cache_ttl,
+            geo_index = geo_index,
+            geo_index_path = geo_index_path,
+            codec = codec
+        )
         if demo:
+            # the generator runs in this process, its watcher shares the pool the proxy created with its settings
             generator = AttacksGenerator(
-                silent = True
+                silent = True,
+                transport = transport,
+                redis_ip = redis_ip,
+                redis_port = redis_port,
+                redis_socket = redis_socket,
+                redis_pool_size = redis_pool_size,
+                redis_health_check = redis_health_check
             )
             
             thread = threading.Thread(target = generator, args = ())
             thread.daemon = True  # Daemonize thread
             thread.start()  # Start the execution
         
-        proxy: Proxy = Proxy(
-            redis_ip = redis_ip,
-            redis_port = redis_port,
-            database = database,
-            verbose = verbose,
-            silent = silent
-        )
-        proxy.run()
+        if workers > 1:
+            proxy.run_workers(workers)
+        elif transport == "streams":
+            proxy.run_streams()
+        elif asyncio_mode:
+            asyncio.get_event_loop().run_until_complete(proxy.run_async())
+        else:
+            proxy.run()
     except redis.exceptions.ExecAbortError:
         exit(0)
 
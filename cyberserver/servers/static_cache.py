@@ -0,0 +1,180 @@
+import os
+import gzip
+import time
+import hashlib
+import pathlib
+import mimetypes
+import threading
+from typing import Optional, Dict, Tuple, Callable, Union
+
+from tornado import web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# content encodings served from memory, in order of preference, brotli only if installed
+ENCODINGS = ["br", "gzip"] if brotli is not None else ["gzip"]
+
+# smaller bodies are not worth compressing, compressed types would not get smaller
+MIN_COMPRESSED_SIZE = 256
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "application/xml", "image/svg+xml")
+
+
+class CachedFile(object):
+    """
+    Body of a file kept in memory with its gzip and brotli variants, compressed once for every version of the file.
+    
+    The file is checked at most every check_interval seconds and read again when its mtime or size changed, so
+    requests cost a dictionary lookup instead of reading, rendering or compressing the file.
+    """
+    
+    def __init__(
+            self,
+            path: Union[str, pathlib.Path],
+            transform: Optional[Callable[[bytes], bytes]] = None,
+            check_interval: float = 1.0
+    ):
+        """
+        :param path: file to serve
+        :param transform: turns the content of the file into the body to serve, e.g. renders a template
+        :param check_interval: seconds between two checks of the file for a new version
+        """
+        self.path = pathlib.Path(path)
+        self.transform = transform
+        self.check_interval: float = check_interval
+        self.content_type: str = mimetypes.guess_type(str(self.path))[0] or "application/octet-stream"
+        
+        # encoding -> (body, etag), identity being the uncompressed body
+        self.variants: Dict[str, Tuple[bytes, str]] = dict()
+        self.signature: Optional[Tuple[int, int]] = None
+        self.checked: float = 0.0
+        self._lock = threading.Lock()
+    
+    def refresh(self, transform: Optional[Callable[[bytes], bytes]] = None) -> bool:
+        """
+        Reads the file again if it changed since the latest read
+        
+        :param transform: used instead of the transform of the file, e.g. renders with the namespace of a handler
+        :return: True if the variants were replaced
+        :raise FileNotFoundError: if the file does not exist anymore
+        """
+        now = time.monotonic()
+        if self.variants and now - self.checked < self.check_interval:
+            return False
+        
+        with self._lock:
+            self.checked = now
+            stat = self.path.stat()
+            signature = (stat.st_mtime_ns, stat.st_size)
+            if signature == self.signature:
+                return False
+            
+            content = self.path.read_bytes()
+            transform = transform or self.transform
+            body = transform(content) if transform else content
+            digest = hashlib.sha1(body).hexdigest()
+            
+            variants = {"identity": (body, f'"{digest}"')}
+            if len(body) >= MIN_COMPRESSED_SIZE and self.content_type.startswith(COMPRESSIBLE_TYPES):
+                variants["gzip"] = (gzip.compress(body, compresslevel = 9, mtime = 0), f'"{digest}-gzip"')
+                if brotli is not None:
+                    variants["br"] = (brotli.compress(body, quality = 11), f'"{digest}-br"')
+            
+            self.variants = variants
+            self.signature = signature
+            return True
+    
+    def select(self, accept_encoding: str) -> Tuple[str, bytes, str]:
+        """ The preferred variant the client accepts, as (encoding, body, etag) """
+        accepted = set()
+        for token in accept_encoding.split(","):
+            name, _, parameters = token.strip().partition(";")
+            if parameters.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+                continue
+            accepted.add(name.strip().lower())
+        
+        variants = self.variants
+        for encoding in ENCODINGS:
+            if encoding in variants and (encoding in accepted or "*" in accepted):
+                return (encoding, *variants[encoding])
+        return ("identity", *variants["identity"])
+
+
+class CachedFileHandler(web.RequestHandler):
+    """ Serves CachedFiles with ETag revalidation, If-None-Match answered with 304 Not Modified """
+    
+    def serve(
+            self,
+            cached: CachedFile,
+            include_body: bool = True,
+            transform: Optional[Callable[[bytes], bytes]] = None
+    ):
+        try:
+            cached.refresh(transform)
+        except FileNotFoundError:
+            raise web.HTTPError(404)
+        
+        encoding, body, etag = cached.select(self.request.headers.get("Accept-Encoding", ""))
+        self.set_header("Content-Type", cached.content_type)
+        self.set_header("Cache-Control", "no-cache")
+        self.set_header("Vary", "Accept-Encoding")
+        self.set_header("Etag", etag)
+        
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        
+        if encoding != "identity":
+            self.set_header("Content-Encoding", encoding)
+        if include_body:
+            self.write(body)
+        else:
+            self.set_header("Content-Length", len(body))
+    
+    def compute_etag(self) -> Optional[str]:
+        # the etag of the variant is set by serve, tornado must not hash the body of every response
+        return None
+
+
+class CachedStaticFileHandler(CachedFileHandler):
+    """ Files of a directory served from memory, e.g. the scripts and styles of the map without NGINX """
+    
+    # absolute path -> cached file, shared by the handlers of the process
+    files: Dict[str, CachedFile] = dict()
+    
+    @classmethod
+    def preload(cls, path: Union[str, pathlib.Path]) -> int:
+        """
+        Reads and compresses every file of the directory, before the first request asks for them
+        
+        :return: number of files cached
+        """
+        root = os.path.realpath(path)
+        for folder, _, names in os.walk(root):
+            for name in names:
+                file = os.path.join(folder, name)
+                cls.files.setdefault(file, CachedFile(file)).refresh()
+        return sum(1 for file in cls.files if file.startswith(root + os.sep))
+    
+    def initialize(self, path: Union[str, pathlib.Path]):
+        self.root: str = os.path.realpath(path)
+    
+    def cached(self, name: str) -> CachedFile:
+        path = os.path.realpath(os.path.join(self.root, name))
+        # no file outside of the directory, whatever the name
+        if not path.startswith(self.root + os.sep) or not os.path.isfile(path):
+            raise web.HTTPError(404)
+        
+        cached = self.files.get(path)
+        if cached is None:
+            cached = self.files.setdefault(path, CachedFile(path))
+        return cached
+    
+    def head(self, name: str):
+        self.serve(self.cached(name), include_body = False)
+    
+    def get(self, name: str):
+        self.serve(self.cached(name))
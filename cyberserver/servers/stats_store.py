@@ -0,0 +1,135 @@
+import os
+import json
+import time
+import pathlib
+from collections import deque
+from typing import Optional, Dict, List, Tuple, Any, Union, Deque
+
+import redis
+
+
+# where the statistics survive a restart of the proxy
+STATS_STORES = ["file", "redis"]
+# how the statistics file is written: indented or on a single line
+STATS_FORMATS = ["json", "compact"]
+# rolling windows of the statistics: name -> (span in seconds, buckets)
+WINDOWS: Dict[str, Tuple[int, int]] = {
+    "1m": (60, 12),
+    "1h": (3600, 30),
+    "24h": (86400, 48),
+}
+
+
+class RollingWindow(object):
+    """
+    Counters of the last span seconds, derived from cumulative counters.
+    
+    A ring keeps a copy of the cumulative counters every span / buckets seconds and the counts of the window are
+    the current counters minus the oldest copy still in the span. Recording an attack costs nothing more than the
+    cumulative counters do and the memory is bound by the number of buckets, whatever the traffic.
+    """
+    
+    def __init__(self, span: float, buckets: int):
+        if span <= 0 or buckets < 1:
+            raise ValueError("span and buckets of a rolling window must be positive")
+        
+        self.span: float = span
+        self.width: float = span / buckets
+        # (time, {section: {key: cumulative count}})
+        self.ring: Deque[Tuple[float, Dict[str, Dict[str, int]]]] = deque(maxlen = buckets + 1)
+    
+    def record(self, counters: Dict[str, Dict[str, int]], now: Optional[float] = None):
+        """ Keeps a copy of the cumulative counters if the latest one is at least a bucket old """
+        now = time.time() if now is None else now
+        if not self.ring or now - self.ring[-1][0] >= self.width:
+            self.ring.append((now, counters))
+    
+    def counts(self, counters: Dict[str, Dict[str, int]], now: Optional[float] = None) -> Dict[str, Dict[str, int]]:
+        """ Non-zero counts of the window, given the current cumulative counters """
+        now = time.time() if now is None else now
+        ring = list(self.ring)
+        if not ring:
+            return {
+                section: {key: count for key, count in values.items() if count} for section, values in counters.items()
+            }
+        
+        base = ring[-1][1]
+        for taken, snapshot in ring:
+            if taken >= now - self.span:
+                base = snapshot
+                break
+        
+        counts = dict()
+        for section, values in counters.items():
+            previous = base.get(section, dict())
+            counts[section] = {
+                key: count - previous.get(key, 0) for key, count in values.items() if count > previous.get(key, 0)
+            }
+        return counts
+    
+    def dump(self) -> List[List[Any]]:
+        return [[taken, counters] for taken, counters in list(self.ring)]
+    
+    def load(self, entries: List[List[Any]], now: Optional[float] = None):
+        """ Restores the copies of a previous run that are still in the span """
+        now = time.time() if now is None else now
+        self.ring.clear()
+        for taken, counters in entries:
+            if taken >= now - self.span - self.width:
+                self.ring.append((taken, counters))
+
+
+class FileStatsStore(object):
+    """ Statistics in a json file, replaced at once on every save """
+    
+    def __init__(self, path: Union[str, pathlib.Path], fmt: str = "json"):
+        if fmt not in STATS_FORMATS:
+            raise ValueError(f"Format {fmt} is not defined. Use one of the following [{','.join(STATS_FORMATS)}]")
+        
+        self.path = pathlib.Path(path)
+        self.fmt: str = fmt
+    
+    def load(self) -> Optional[Dict[str, Any]]:
+        try:
+            with self.path.open(mode = "r", encoding = 'utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+    
+    def save(self, state: Dict[str, Any]):
+        """ Writes to a temporary file that replaces the file once complete, readers never see a partial document """
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+        temporary = self.path.with_name(f".{self.path.name}.tmp")
+        with temporary.open(mode = "w", encoding = 'utf-8') as f:
+            if self.fmt == "json":
+                json.dump(state, f, ensure_ascii = False, indent = 4, sort_keys = True)
+            else:
+                json.dump(state, f, ensure_ascii = False, separators = (",", ":"))
+        os.replace(temporary, self.path)
+    
+    def __str__(self):
+        return str(self.path)
+
+
+class RedisStatsStore(object):
+    """ Statistics in a redis hash, one json field per section, replaced at once on every save """
+    
+    def __init__(self, server: redis.Redis, key: str = "cybermap:stats"):
+        self.server = server
+        self.key: str = key
+    
+    def load(self) -> Optional[Dict[str, Any]]:
+        fields = self.server.hgetall(self.key)
+        if not fields:
+            return None
+        return {field.decode("utf-8"): json.loads(value) for field, value in fields.items()}
+    
+    def save(self, state: Dict[str, Any]):
+        # one transaction, readers get every section of the same save
+        pipeline = self.server.pipeline(transaction = True)
+        for section, value in state.items():
+            pipeline.hset(self.key, section, json.dumps(value, separators = (",", ":")))
+        pipeline.execute()
+    
+    def __str__(self):
+        return f"redis hash {self.key}"
@@ -4,7 +4,12 @@ Utilities package
 An opinionated, minimal template for utilities needed for cyberserver
 """
 
-from .redis_watcher import RedisWatcher
+from .redis_watcher import RedisWatcher, TRANSPORTS, STREAM_GROUP, DEAD_LETTERS_SUFFIX
+from .ring_buffer import RingBuffer
+from .ranked_counter import RankedCounter
+from .publish_batcher import PublishBatcher
+from .codec import CODECS, Codec, available_codecs, get_codec, use_codec, dumps, loads
+from .wire import WIRE_FORMATS, ATTACK_TYPES, encode_attack, decode_attack
 
 from .logging import (
     get_console_logger,
@@ -49,5 +54,22 @@ __all__ = [
     "get_platform",
     "confirmation",
     "get_time",
-    "RedisWatcher"
+    "RedisWatcher",
+    "TRANSPORTS",
+    "STREAM_GROUP",
+    "DEAD_LETTERS_SUFFIX",
+    "RingBuffer",
+    "RankedCounter",
+    "PublishBatcher",
+    "CODECS",
+    "Codec",
+    "available_codecs",
+    "get_codec",
+    "use_codec",
+    "dumps",
+    "loads",
+    "WIRE_FORMATS",
+    "ATTACK_TYPES",
+    "encode_attack",
+    "decode_attack",
 ]
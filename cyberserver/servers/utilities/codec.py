@@ -0,0 +1,103 @@
+"""
+JSON codec of the messages exchanged through redis.
+
+orjson is used when it is installed, msgspec otherwise and the json module as the fallback. Every codec encodes to
+bytes, decodes bytes as they come from redis, without decoding them to str first, and raises ValueError for
+invalid documents.
+"""
+import json
+from typing import Any, Callable, Dict, List, Optional, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+class Codec(object):
+    
+    def __init__(self, name: str, dumps: Callable[[Any], bytes], loads: Callable[[Union[bytes, str]], Any]):
+        self.name: str = name
+        self.dumps = dumps
+        self.loads = loads
+    
+    def __repr__(self):
+        return f"Codec({self.name})"
+
+
+def _orjson() -> Optional[Codec]:
+    if orjson is None:
+        return None
+    return Codec("orjson", orjson.dumps, orjson.loads)
+
+
+def _msgspec() -> Optional[Codec]:
+    if msgspec is None:
+        return None
+    
+    decode = msgspec.json.decode
+    
+    def loads(data: Union[bytes, str]) -> Any:
+        try:
+            return decode(data)
+        except msgspec.DecodeError as error:
+            raise ValueError(str(error)) from error
+    
+    return Codec("msgspec", msgspec.json.encode, loads)
+
+
+def _json() -> Codec:
+    return Codec("json", lambda obj: json.dumps(obj).encode("utf-8"), json.loads)
+
+
+# in order of preference
+_factories: Dict[str, Callable[[], Optional[Codec]]] = {
+    "orjson": _orjson,
+    "msgspec": _msgspec,
+    "json": _json,
+}
+CODECS: List[str] = list(_factories)
+
+
+def available_codecs() -> List[str]:
+    return [name for name, factory in _factories.items() if factory() is not None]
+
+
+def get_codec(name: Optional[str] = None) -> Codec:
+    """
+    The codec called name, or the first available one
+    
+    :raise ValueError: if name is not defined or its library is not installed
+    """
+    if name is None:
+        return next(codec for codec in (factory() for factory in _factories.values()) if codec is not None)
+    
+    if name not in _factories:
+        raise ValueError(f"Codec: {name} is not defined. Use one of the following [{','.join(CODECS)}]")
+    codec = _factories[name]()
+    if codec is None:
+        raise ValueError(f"Codec: {name} is not installed. Available: [{','.join(available_codecs())}]")
+    return codec
+
+
+codec: Codec = get_codec()
+
+
+def use_codec(name: Optional[str] = None) -> Codec:
+    """ Switches the codec of dumps and loads for the whole process """
+    global codec
+    codec = get_codec(name)
+    return codec
+
+
+def dumps(obj: Any) -> bytes:
+    return codec.dumps(obj)
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    return codec.loads(data)
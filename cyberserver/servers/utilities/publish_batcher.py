@@ -0,0 +1,129 @@
+import time
+import threading
+from typing import List, Optional, Tuple, Union
+
+import redis
+
+
+class PublishBatcher(object):
+    """
+    Publishes messages in batches, one redis pipeline per batch instead of one round trip per message.
+    
+    A batch is sent as soon as it holds batch_size messages or when its first message has waited deadline
+    seconds, whichever comes first, so a slow trickle of messages is delayed by at most deadline. The deadline
+    is kept by a flusher thread, publish never waits for it.
+    """
+    
+    def __init__(
+            self,
+            server: redis.Redis,
+            batch_size: int = 64,
+            deadline: float = 0.01,
+            transport: str = "pubsub",
+            stream_maxlen: Optional[int] = None
+    ):
+        """
+        :param server: redis connection the pipelines are made from
+        :param batch_size: messages of a full batch, 1 publishes every message right away
+        :param deadline: seconds the first message of a batch may wait for the batch to fill up
+        :param transport: publish to pub/sub channels or append to streams of the same names
+        :param stream_maxlen: approximate length the streams are trimmed to
+        """
+        if batch_size < 1:
+            raise ValueError("batch size of the publisher must be a positive integer")
+        
+        self.server: redis.Redis = server
+        self.batch_size: int = batch_size
+        self.deadline: float = deadline
+        self.transport: str = transport
+        self.stream_maxlen: Optional[int] = stream_maxlen
+        
+        self.batch: List[Tuple[str, Union[bytes, str]]] = list()
+        self.batch_started: float = 0.0
+        self.condition = threading.Condition()
+        self.closed: bool = False
+        # failure of a batch sent by the flusher, raised by the next publish
+        self.error: Optional[redis.RedisError] = None
+        
+        # messages and batches sent so far
+        self.published: int = 0
+        self.batches: int = 0
+        self.started: float = time.monotonic()
+        
+        self.flusher: Optional[threading.Thread] = None
+        if batch_size > 1:
+            self.flusher = threading.Thread(target = self.flush_on_deadline, name = "publish-batcher", daemon = True)
+            self.flusher.start()
+    
+    def publish(self, channel: str, message: Union[bytes, str]):
+        with self.condition:
+            if self.error is not None:
+                error, self.error = self.error, None
+                raise error
+            
+            self.batch.append((channel, message))
+            if len(self.batch) >= self.batch_size:
+                self.send()
+            elif len(self.batch) == 1:
+                self.batch_started = time.monotonic()
+                self.condition.notify()
+    
+    def flush(self):
+        with self.condition:
+            self.send()
+    
+    def flush_on_deadline(self):
+        with self.condition:
+            while not self.closed:
+                if not self.batch:
+                    self.condition.wait()
+                    continue
+                
+                remaining = self.batch_started + self.deadline - time.monotonic()
+                if remaining > 0:
+                    self.condition.wait(remaining)
+                    continue
+                
+                try:
+                    self.send()
+                except redis.RedisError as error:
+                    self.error = error
+    
+    def send(self):
+        """ Sends the current batch, the caller holds the condition """
+        if not self.batch:
+            return
+        
+        batch = self.batch
+        self.batch = list()
+        
+        if len(batch) == 1 and self.transport == "pubsub":
+            self.server.publish(*batch[0])
+        else:
+            pipeline = self.server.pipeline(transaction = False)
+            for channel, message in batch:
+                if self.transport == "streams":
+                    pipeline.xadd(channel, {"data": message}, maxlen = self.stream_maxlen, approximate = True)
+                else:
+                    pipeline.publish(channel, message)
+            pipeline.execute()
+        
+        self.published += len(batch)
+        self.batches += 1
+    
+    def close(self):
+        """ Sends what is left and stops the flusher """
+        with self.condition:
+            self.send()
+            self.closed = True
+            self.condition.notify()
+        if self.flusher is not None:
+            self.flusher.join()
+    
+    def rate(self) -> float:
+        """ Messages per second published since the batcher was created """
+        elapsed = time.monotonic() - self.started
+        return self.published / elapsed if elapsed > 0 else 0.0
+    
+    def __len__(self):
+        return len(self.batch)
@@ -0,0 +1,91 @@
+from array import array
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+
+class RankedCounter(object):
+    """
+    Counters of interned keys (0, 1, 2, ...) kept ordered by count, largest first.
+    
+    Counters only grow one at a time, so an increment swaps the counter with the first one of the run of equal
+    counts it leaves and the order stays sorted: incrementing costs O(1) and the k largest counters are the
+    first k of the order, without sorting.
+    """
+    
+    def __init__(self):
+        self.counts = array('Q')  # key -> count
+        self.order = array('L')  # rank -> key, counts descending
+        self.ranks = array('L')  # key -> rank
+        self.starts: Dict[int, int] = dict()  # count -> first rank with that count
+        self.total: int = 0
+    
+    def add(self, key: int):
+        """ Makes sure key and every key before it are counted, starting at 0 """
+        while len(self.counts) <= key:
+            self.counts.append(0)
+            self.ranks.append(len(self.order))
+            self.order.append(len(self.counts) - 1)
+            self.starts.setdefault(0, len(self.order) - 1)
+    
+    def increment(self, key: int):
+        counts = self.counts
+        if key >= len(counts):
+            self.add(key)
+        
+        count = counts[key]
+        counts[key] = count + 1
+        self.total += 1
+        
+        starts = self.starts
+        order = self.order
+        first = starts[count]
+        # key moves to the first rank of the run of count, which becomes the last rank of the run of count + 1
+        if order[first] != key:
+            ranks = self.ranks
+            other = order[first]
+            rank = ranks[key]
+            order[first] = key
+            order[rank] = other
+            ranks[key] = first
+            ranks[other] = rank
+        
+        if first + 1 < len(order) and counts[order[first + 1]] == count:
+            starts[count] = first + 1
+        else:
+            del starts[count]
+        if count + 1 not in starts:
+            starts[count + 1] = first
+    
+    def load(self, counts: Sequence[int]):
+        """ Replaces every counter, counts[key] being the count of key """
+        self.counts = array('Q', counts)
+        self.order = array('L', sorted(range(len(counts)), key = lambda key: counts[key], reverse = True))
+        self.ranks = array('L', [0]) * len(counts)
+        self.starts = dict()
+        for rank, key in enumerate(self.order):
+            self.ranks[key] = rank
+            self.starts.setdefault(counts[key], rank)
+        self.total = sum(counts)
+    
+    def top(self, k: int) -> List[Tuple[int, int]]:
+        """ The k largest non-zero counters as (key, count) """
+        top = list()
+        for key in self.order[:k]:
+            count = self.counts[key]
+            if not count:
+                break
+            top.append((key, count))
+        return top
+    
+    def ranked(self, zeros: bool = False) -> Iterator[Tuple[int, int]]:
+        """ Every counter as (key, count), largest first """
+        for key in self.order:
+            count = self.counts[key]
+            if not count and not zeros:
+                break
+            yield key, count
+    
+    def __getitem__(self, key: int) -> int:
+        return self.counts[key] if key < len(self.counts) else 0
+    
+    def __len__(self) -> int:
+        return len(self.counts)
@@ -1,12 +1,15 @@
 import os
+import asyncio
+import logging
 from copy import deepcopy
 
 import redis
+import aioredis
 import socket
 import uuid
 
 from options import Options
-from typing import Optional, Any, Dict, List, Type
+from typing import Optional, Any, Dict, List, Type, Tuple, Union
 
 from .colors import colorize
 from .logging import get_console_logger
@@ -15,11 +18,37 @@ from .platform import confirmation
 from redis.exceptions import ExecAbortError
 
 
+# how the components hand messages to each other: plain pub/sub channels or redis streams of the same names
+TRANSPORTS = ["pubsub", "streams"]
+
+# consumer group of the proxies that read the raw attacks stream
+STREAM_GROUP = "cybermap-proxy"
+# entries of the raw attacks stream that could not be processed are moved to <stream>:dead-letters
+DEAD_LETTERS_SUFFIX = ":dead-letters"
+
+# (host or unix socket path, port or None, db)
+PoolKey = Tuple[str, Optional[int], int]
+
+logger = logging.getLogger(__name__)
+
+
 class RedisWatcher(object):
+    """
+    Connection of a component to redis.
+    
+    Watchers of the same redis server share one connection pool per process, keyed by host, port and db, so the
+    proxy, its demo generator and its threads reuse the same connections instead of opening their own. With a unix
+    socket the pool connects through the socket and a redis on the same host skips TCP. async_pool is the asyncio
+    counterpart for the SSE servers and the asyncio proxy, one aioredis pool per server and event loop.
+    """
     
     active_watchers: Dict[int, Any] = dict()
     active_services: List[Any] = list()
     IDs: List[int] = list()
+    pools: Dict[PoolKey, redis.ConnectionPool] = dict()
+    # settings the pools were created with
+    pool_settings: Dict[PoolKey, Dict[str, Any]] = dict()
+    async_pools: Dict[PoolKey, Tuple[asyncio.AbstractEventLoop, aioredis.Redis]] = dict()
     
     class Service(object):
         
@@ -34,42 +63,173 @@ class RedisWatcher(object):
             return self.host == other.host and self.port == other.port
         
         def __str__(self):
-            return f"{colorize(f'{self.host}:{self.port}', color = 'gold_1')}"
+            return f"{colorize(self.host if self.port is None else f'{self.host}:{self.port}', color = 'gold_1')}"
     
     def __init__(
             self,
             ip: Optional[str] = "127.0.0.1",
             port: Optional[int] = 6379,
-            silent: Optional[bool] = False
+            silent: Optional[bool] = False,
+            db: int = 0,
+            unix_socket: Optional[str] = None,
+            max_connections: Optional[int] = 64,
+            socket_keepalive: bool = True,
+            health_check_interval: float = 30
     ):
+        """
+        :param ip: host of the redis server
+        :param port: port of the redis server
+        :param silent: disables the logging messages
+        :param db: redis database
+        :param unix_socket: path of the unix socket of the redis server, used instead of ip and port
+        :param max_connections: connections of the shared pool, None for no limit
+        :param socket_keepalive: enables TCP keepalive, so idle connections survive NATs and firewalls
+        :param health_check_interval: seconds a connection may be idle before it is checked with a PING on reuse,
+                                      0 disables the checks
+        """
         unique_id: int = int(str(uuid.uuid4().int)[:-29])  # make a completely random UUID
         if unique_id in self.IDs:
             raise Exception(f"ID {unique_id} already exists for a RedisWatcher instance. Something went wrong")
-
+        
         self._logger = get_console_logger(name = f"RedisWatcher-{unique_id}", disable_stream = True if silent else False)
         
         self.options: Options = Options(**{
             "ip": ip,
             "port": port,
+            "db": db,
+            "unix_socket": unix_socket,
             "id": unique_id
         })
         
+        self.pool: redis.ConnectionPool = self.connection_pool(
+            ip = ip,
+            port = port,
+            db = db,
+            unix_socket = unix_socket,
+            max_connections = max_connections,
+            socket_keepalive = socket_keepalive,
+            health_check_interval = health_check_interval
+        )
+        
         if not self.start_service(autostart = True):
             raise ExecAbortError()
-
+        
         self.server: Optional[redis.client.Redis] = self.connect()
         self.IDs.append(unique_id)
         self.active_watchers[unique_id] = self
         self._logger.info(f"Watcher created for {self}")
     
+    @classmethod
+    def pool_key(cls, ip: str, port: Optional[int], db: int = 0, unix_socket: Optional[str] = None) -> PoolKey:
+        return (unix_socket, None, db) if unix_socket else (ip, port, db)
+    
+    @classmethod
+    def async_pool_key(cls, address: Union[Tuple[str, int], str], db: int = 0) -> PoolKey:
+        return cls.pool_key(*address, db = db) if isinstance(address, tuple) else cls.pool_key("", None, db, address)
+    
+    @classmethod
+    def connection_pool(
+            cls,
+            ip: str = "127.0.0.1",
+            port: Optional[int] = 6379,
+            db: int = 0,
+            unix_socket: Optional[str] = None,
+            max_connections: Optional[int] = 64,
+            socket_keepalive: bool = True,
+            health_check_interval: float = 30
+    ) -> redis.ConnectionPool:
+        """
+        The pool of the process for a redis server, created by the first watcher of that server. A later watcher
+        gets that pool whatever its own settings, a warning tells when they differ.
+        """
+        key = cls.pool_key(ip, port, db, unix_socket)
+        pool = cls.pools.get(key)
+        settings = dict(
+            max_connections = max_connections,
+            socket_keepalive = socket_keepalive,
+            health_check_interval = health_check_interval
+        )
+        if pool is not None:
+            ignored = [
+                f"{name}={value} (pool: {cls.pool_settings[key][name]})"
+                for name, value in settings.items() if value != cls.pool_settings[key][name]
+            ]
+            if ignored:
+                logger.warning(f"Reusing the redis pool of {key}, ignoring {', '.join(ignored)}")
+            return pool
+        
+        # blocking reads (pub/sub, XREADGROUP) wait for their own timeouts, the sockets must not time out first
+        if unix_socket:
+            pool = redis.ConnectionPool(
+                connection_class = redis.UnixDomainSocketConnection,
+                max_connections = max_connections,
+                path = unix_socket,
+                db = db,
+                socket_timeout = None,
+                health_check_interval = health_check_interval
+            )
+        else:
+            pool = redis.ConnectionPool(
+                max_connections = max_connections,
+                host = ip,
+                port = port,
+                db = db,
+                socket_timeout = None,
+                socket_keepalive = socket_keepalive,
+                health_check_interval = health_check_interval
+            )
+        cls.pool_settings.setdefault(key, settings)
+        return cls.pools.setdefault(key, pool)
+    
+    @classmethod
+    async def async_pool(
+            cls,
+            address: Union[Tuple[str, int], str] = ("127.0.0.1", 6379),
+            db: int = 0,
+            minsize: int = 1,
+            maxsize: int = 10
+    ) -> aioredis.Redis:
+        """
+        The aioredis pool of the running event loop for a redis server, address being (host, port) or the path of
+        a unix socket
+        """
+        key = cls.async_pool_key(address, db)
+        loop = asyncio.get_event_loop()
+        entry = cls.async_pools.get(key)
+        if entry is not None and entry[0] is loop and not entry[1].closed:
+            return entry[1]
+        
+        pool = await aioredis.create_redis_pool(address, db = db, minsize = minsize, maxsize = maxsize)
+        # another coroutine may have created the pool while this one was connecting
+        entry = cls.async_pools.get(key)
+        if entry is not None and entry[0] is loop and not entry[1].closed:
+            pool.close()
+            await pool.wait_closed()
+            return entry[1]
+        
+        cls.async_pools[key] = (loop, pool)
+        return pool
+    
+    @classmethod
+    async def close_async_pool(cls, address: Union[Tuple[str, int], str] = ("127.0.0.1", 6379), db: int = 0):
+        key = cls.async_pool_key(address, db)
+        entry = cls.async_pools.pop(key, None)
+        if entry is not None and not entry[1].closed:
+            entry[1].close()
+            await entry[1].wait_closed()
+    
+    @classmethod
+    def close_pools(cls):
+        """ Closes the connections of every pool of the process """
+        for pool in cls.pools.values():
+            pool.disconnect()
+        cls.pools.clear()
+        cls.pool_settings.clear()
+    
     def connect(self) -> redis.Redis:
         try:
-            server = redis.Redis(
-                host = self.ip,
-                port = self.port,
-                db = 0,
-                health_check_interval = 0
-            )
+            # the pool outlives the client, closing the client leaves the connections to the other watchers
+            server = redis.Redis(connection_pool = self.pool)
             return server
         except redis.exceptions.RedisError:
             self._logger.exception(
@@ -90,14 +250,7 @@ class RedisWatcher(object):
         Make sure system can use a lot of memory and overcommit memory
         """
         try:
-            connection = redis.Connection(
-                host = self.ip,
-                port = self.port,
-                db = 0,
-                health_check_interval = 5
-            )
-            connection.check_health()
-            connection.disconnect()
+            redis.Redis(connection_pool = self.pool).ping()
         except redis.ConnectionError:
             self._logger.warning("Redis Server is not currently active")
             if not autostart:
@@ -114,7 +267,7 @@ class RedisWatcher(object):
                 self._logger.warning("If this was due to root permissions please use sudo or login as root")
                 return None
         
-        service = RedisWatcher.Service(self.ip, self.port)
+        service = RedisWatcher.Service(self.unix_socket or self.ip, None if self.unix_socket else self.port)
         
         if service not in self.active_services:
             self._logger.info(f"Redis Server {service} is {colorize('live')}")
@@ -125,11 +278,16 @@ class RedisWatcher(object):
     def update_options(self, **kwargs):
         self.options.set(**kwargs)
     
+    @property
+    def address(self) -> Union[Tuple[str, int], str]:
+        """ Address of the server as aioredis takes it """
+        return self.unix_socket or (self.ip, self.port)
+    
     def __str__(self):
-        return f"{colorize(self.id, color = 'sky_blue_1')} -> {colorize(f'{self.ip}:{self.port}', color = 'gold_1')}"
+        return f"{colorize(self.id, color = 'sky_blue_1')} -> {colorize(repr(self), color = 'gold_1')}"
     
     def __repr__(self):
-        return f"{self.ip}:{self.port}"
+        return self.unix_socket or f"{self.ip}:{self.port}"
     
     # region Getters & Setters
     @property
@@ -148,6 +306,14 @@ class RedisWatcher(object):
     def port(self, value):
         self.update_options(port = value)
     
+    @property
+    def db(self):
+        return self.options.db
+    
+    @property
+    def unix_socket(self):
+        return self.options.unix_socket
+    
     @property
     def id(self):
         return self.options.id
@@ -0,0 +1,57 @@
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+
+class RingBuffer(object):
+    """
+    Fixed-size buffer of items indexed by their event id.
+    
+    Appending overwrites the oldest slot in place and reading back everything after an id costs
+    O(items after that id), no matter how many items the buffer holds.
+    """
+    
+    def __init__(self, size: int = 200):
+        if size < 1:
+            raise ValueError("size of a ring buffer must be a positive integer")
+        
+        self.size: int = size
+        self.slots: List[Optional[Tuple[Hashable, Any]]] = [None] * size
+        self.positions: Dict[Hashable, int] = dict()  # event id -> absolute position of its item
+        self.head: int = 0  # absolute position of the next item
+    
+    def append(self, event_id: Hashable, item: Any):
+        slot = self.head % self.size
+        evicted = self.slots[slot]
+        if evicted is not None:
+            self.positions.pop(evicted[0], None)
+        
+        self.slots[slot] = (event_id, item)
+        self.positions[event_id] = self.head
+        self.head += 1
+    
+    def since(self, event_id: Hashable) -> Optional[List[Any]]:
+        """
+        Items appended after the one with event_id
+        
+        :return: the items in order or None if event_id was never buffered or has already been overwritten
+        """
+        position = self.positions.get(event_id)
+        if position is None:
+            return None
+        
+        return [self.slots[p % self.size][1] for p in range(position + 1, self.head)]
+    
+    def latest(self) -> Optional[Tuple[Hashable, Any]]:
+        if not self.head:
+            return None
+        return self.slots[(self.head - 1) % self.size]
+    
+    def clear(self):
+        self.slots = [None] * self.size
+        self.positions.clear()
+        self.head = 0
+    
+    def __contains__(self, event_id: Hashable) -> bool:
+        return event_id in self.positions
+    
+    def __len__(self) -> int:
+        return min(self.head, self.size)
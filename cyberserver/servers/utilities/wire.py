@@ -0,0 +1,111 @@
+"""
+Wire format of the raw attacks published by the generators.
+
+Raw attacks share a small fixed schema: source and destination ip and port, attack type and CVE. The binary format
+packs it in a fixed-size record, IPv4 addresses as 4 bytes, the type as its index in ATTACK_TYPES and the CVE as a
+year and a number, about 6 times smaller than the JSON text, and decodes without a parser.
+
+A binary record starts with WIRE_MAGIC, a byte that cannot start a JSON document, so the proxy tells both formats
+apart message by message and JSON producers keep working on the same channel. Attacks that do not fit a record
+(IPv6 addresses, unknown types, CVEs of another form) are published as JSON by the binary producers too.
+"""
+import re
+import socket
+import struct
+from typing import Any, Dict, List, Optional, Union
+
+from .codec import dumps, loads
+
+
+WIRE_FORMATS = ["json", "binary"]
+WIRE_MAGIC = 0xC1
+# append only, the index of a type is what binary records carry
+ATTACK_TYPES: List[str] = [
+    "AUTH", "DNS", "DoS", "EMAIL", "FTP", "HTTP", "HTTPS", "ICMP", "RDP", "SFTP", "SMB", "SNMP", "SQL", "SSH",
+    "TELNET", "WHOIS",
+]
+
+# magic, src ip, src port, dst ip, dst port, type, cve year, cve number
+_record = struct.Struct("!B4sH4sHBHI")
+_magic = bytes([WIRE_MAGIC])
+_type_ids: Dict[str, int] = {name: index for index, name in enumerate(ATTACK_TYPES)}
+# the form the generators use, the only one a record gives back exactly, CVE-2019-0708 is published as JSON
+CVE_PATTERN = re.compile(r"CVE:(\d{4}):([1-9]\d*)$")
+
+
+def pack_attack(attack: Dict[str, Any]) -> Optional[bytes]:
+    """ Binary record of a raw attack, or None if the attack does not fit one """
+    type_id = _type_ids.get(attack["type"])
+    cve = attack["cve"]
+    match = CVE_PATTERN.match(cve) if isinstance(cve, str) else None
+    if type_id is None or match is None:
+        return None
+    
+    year, number = int(match.group(1)), int(match.group(2))
+    # a record must decode to the very same identifier, e.g. not for a year with a leading zero
+    if number > 0xFFFFFFFF or f"CVE:{year}:{number}" != cve:
+        return None
+    
+    try:
+        # inet_pton takes the dotted quad only, inet_aton would pack 010.0.0.1 as 8.0.0.1 and 1.2 as 1.0.0.2
+        return _record.pack(
+            WIRE_MAGIC,
+            socket.inet_pton(socket.AF_INET, attack["src"]["ip"]),
+            attack["src"]["port"],
+            socket.inet_pton(socket.AF_INET, attack["dst"]["ip"]),
+            attack["dst"]["port"],
+            type_id,
+            year,
+            number
+        )
+    except (OSError, TypeError, struct.error):
+        # not an IPv4 address or a port out of range
+        return None
+
+
+def unpack_attack(raw: bytes) -> Dict[str, Any]:
+    """ Raw attack of a binary record """
+    try:
+        _, src_ip, src_port, dst_ip, dst_port, type_id, year, number = _record.unpack(raw)
+        attack_type = ATTACK_TYPES[type_id]
+    except (struct.error, IndexError) as error:
+        raise ValueError(f"Invalid binary attack record: {error}") from error
+    
+    return {
+        "src": {
+            "ip": socket.inet_ntoa(src_ip),
+            "port": src_port
+        },
+        "dst": {
+            "ip": socket.inet_ntoa(dst_ip),
+            "port": dst_port
+        },
+        "type": attack_type,
+        "cve": f"CVE:{year}:{number}",
+    }
+
+
+def encode_attack(attack: Dict[str, Any], wire: str = "json") -> bytes:
+    """
+    A raw attack as published on the raw attacks channel
+    
+    :raise ValueError: if wire is not defined
+    """
+    if wire == "binary":
+        record = pack_attack(attack)
+        if record is not None:
+            return record
+    elif wire != "json":
+        raise ValueError(f"Wire format: {wire} is not defined. Use one of the following [{','.join(WIRE_FORMATS)}]")
+    return dumps(attack)
+
+
+def decode_attack(raw: Union[bytes, str]) -> Dict[str, Any]:
+    """
+    A raw attack of either wire format, told apart by its first byte
+    
+    :raise ValueError: if raw is neither a binary record nor a JSON document
+    """
+    if raw[:1] == _magic:
+        return unpack_attack(raw)
+    return loads(raw)
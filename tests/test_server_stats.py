@@ -0,0 +1,110 @@
+"""
+Stress test of ServerStats: threads record attacks while other threads read the statistics the way the stats-worker
+and the snapshotter do, every read must be consistent and the final counters exact.
+"""
+import random
+import threading
+import unittest
+from collections import Counter
+from typing import List, Tuple
+
+from cyberserver.servers.proxy import ServerStats, StatsEncoder
+from cyberserver.servers.utilities import ATTACK_TYPES
+
+
+COUNTRIES = ["Greece", "Germany", "China", "United States", "Brazil", "Russia", "India", "France", None]
+
+
+def attacks_of(seed: int, attacks: int) -> List[Tuple[str, str, str]]:
+    generator = random.Random(seed)
+    return [
+        (generator.choice(ATTACK_TYPES), generator.choice(COUNTRIES), generator.choice(COUNTRIES))
+        for _ in range(attacks)
+    ]
+
+
+class ServerStatsStressTest(unittest.TestCase):
+    writers = 4
+    readers = 4
+    attacks = 20000
+    
+    def check_read(self, stats: ServerStats, previous_total: int) -> int:
+        """ Checks the counters of one read, with the lock held, and returns their total """
+        types = stats.types
+        total = types["TOTAL"]
+        self.assertGreaterEqual(total, previous_total, "the total went back")
+        self.assertEqual(sum(count for protocol, count in types.items() if protocol != "TOTAL"), total)
+        
+        countries = stats.countries
+        self.assertEqual(countries["TOTAL"], 2 * total, "every attack counts a source and a destination country")
+        for name, country in countries.items():
+            if name == "TOTAL":
+                continue
+            directions = [country[direction] for direction in ServerStats.DIRECTIONS if direction in country]
+            self.assertEqual(sum(direction["TOTAL"] for direction in directions), country["TOTAL"], name)
+            for direction in directions:
+                self.assertEqual(
+                    sum(count for protocol, count in direction.items() if protocol != "TOTAL"),
+                    direction["TOTAL"],
+                    name
+                )
+        
+        totals = stats.totals()
+        for direction in ServerStats.DIRECTIONS:
+            self.assertEqual(sum(totals[direction].values()), total, direction)
+        
+        stats.snapshot()
+        return total
+    
+    def test_concurrent_reads_are_consistent(self):
+        feeds = [attacks_of(seed, self.attacks) for seed in range(self.writers)]
+        stats = ServerStats()
+        done = threading.Event()
+        reads = Counter()
+        errors: List[BaseException] = list()
+        
+        def ingest(feed: List[Tuple[str, str, str]]):
+            for attack in feed:
+                stats.record(*attack)
+        
+        def read(index: int):
+            encoder = StatsEncoder(snapshot_every = 5)
+            total = 0
+            try:
+                while not done.is_set():
+                    with stats.reading() as current:
+                        total = self.check_read(current, total)
+                        encoder.encode(current)
+                    reads[index] += 1
+            except BaseException as error:
+                errors.append(error)
+        
+        reader_threads = [threading.Thread(target = read, args = (index,)) for index in range(self.readers)]
+        writer_threads = [threading.Thread(target = ingest, args = (feed,)) for feed in feeds]
+        for thread in reader_threads + writer_threads:
+            thread.start()
+        for thread in writer_threads:
+            thread.join()
+        done.set()
+        for thread in reader_threads:
+            thread.join()
+        
+        if errors:
+            raise errors[0]
+        self.assertGreater(sum(reads.values()), 0, "no read ran while the attacks were recorded")
+        
+        attacks = [attack for feed in feeds for attack in feed]
+        unknown = ServerStats.UNKNOWN_COUNTRY
+        with stats.reading() as current:
+            self.check_read(current, 0)
+            totals = current.totals()
+        self.assertEqual(
+            {protocol: count for protocol, count in totals["types"].items() if count},
+            Counter(protocol for protocol, _, _ in attacks)
+        )
+        self.assertEqual(totals["incoming"], Counter(source or unknown for _, source, _ in attacks))
+        self.assertEqual(totals["outgoing"], Counter(destination or unknown for _, _, destination in attacks))
+
+
+if __name__ == '__main__':
+    unittest.main()